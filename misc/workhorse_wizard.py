@@ -1,13 +1,37 @@
-import sys
+"""
+WorkHorse configuration client.
 
-import serial
+Every command waits for the `>` prompt (with a per-command timeout) instead of
+sleeping, and the echo and reply are verified. Many instruments are configured
+concurrently, one thread per port:
+
+    python -m misc.workhorse_wizard deploy /dev/ttyUSB0 /dev/ttyUSB1 -b 115200
+"""
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+import click
+import serial
 
 ENCODING = "ascii"
+PROMPT = ">"
+DEFAULT_TIMEOUT = 2
+BREAK_TIMEOUT = 3
+COMMAND_TIMEOUTS = {"CK": 5, "CR": 5}  # Commands writing to the non-volatile memory are slower.
+NO_PROMPT_COMMANDS = {"CS", "CZ"}  # Deploy and power down do not return a prompt.
+
+
+class WizardError(Exception):
+    pass
+
 
 class Wizard:
-    def __init__(self, port: str, bauderate):
+    def __init__(self, port: str, bauderate, verbose=True):
+        self.port = port
+        self.verbose = verbose
         self.serial = serial.Serial()
         self.serial.bytesize = serial.EIGHTBITS
         self.serial.parity = serial.PARITY_NONE
@@ -15,26 +39,81 @@ class Wizard:
         self.serial.baudrate = bauderate
         self.serial.port = port
         self.serial.open()
-        self.serial.timeout = .1
-
-    def enter_command_mode(self):
-        self.serial.send_break()
-        time.sleep(1)
+        self.serial.timeout = .05
+
+    def print(self, msg: str):
+        if self.verbose:
+            print(f"[{self.port}] {msg.strip()}")
+
+    def read_until_prompt(self, timeout: float = DEFAULT_TIMEOUT, prompts: int = 1) -> str:
+        """Reads until `prompts` prompts are received. Raises WizardError on timeout."""
+        return self.read_until(PROMPT, timeout, count=prompts)
+
+    def read_until(self, expected: str, timeout: float = DEFAULT_TIMEOUT, count: int = 1) -> str:
+        """Reads until `expected` is received `count` times. Raises WizardError on timeout."""
+        deadline = time.monotonic() + timeout
+        buff = b""
+        while buff.count(expected.encode(ENCODING)) < count:
+            if time.monotonic() > deadline:
+                raise WizardError(f"{self.port}: timeout waiting for `{expected!r}`. Received: {buff!r}")
+            buff += self.serial.read(max(1, self.serial.in_waiting))
         try:
-            answer = self.serial.read_all().decode(ENCODING)
-            print(answer)
+            return buff.decode(ENCODING)
         except UnicodeError:
-            print("NO RETURN: Wrong Bauderate")
-            sys.exit()
+            raise WizardError(f"{self.port}: unreadable reply, wrong bauderate ?")
 
-    def send(self, command: str, value: str = ""):
-        self.serial.write((command + value + '\r').encode(ENCODING))
-        time.sleep(1)
-        try:
-            answer = self.serial.read_all().decode(ENCODING)
-            print(answer)
-        except UnicodeError:
-            print("NO RETURN: Bauderate change")
+    def enter_command_mode(self, timeout: float = BREAK_TIMEOUT):
+        self.serial.reset_input_buffer()
+        self.serial.send_break()
+        self.print(self.read_until_prompt(timeout))
+
+    def wake_up(self, timeout: float = DEFAULT_TIMEOUT):
+        """Sends an empty command and waits for the prompt (e.g. after a bauderate change)."""
+        self.serial.reset_input_buffer()
+        self.serial.write(b"\r")
+        self.read_until_prompt(timeout)
+
+    def check_reply(self, command: str, reply: str):
+        if command.strip() not in reply:
+            raise WizardError(f"{self.port}: `{command.strip()}` not echoed. Received: {reply!r}")
+        if "ERR" in reply.upper():
+            raise WizardError(f"{self.port}: `{command.strip()}` failed: {reply.strip()}")
+
+    def send(self, command: str, value: str = "", timeout: float = None) -> str:
+        """Sends a command, waits for the prompt and verifies the echo and reply."""
+        msg = command + value
+        self.serial.write((msg + "\r").encode(ENCODING))
+
+        timeout = timeout or COMMAND_TIMEOUTS.get(command, DEFAULT_TIMEOUT)
+        if command in NO_PROMPT_COMMANDS:
+            reply = self.read_until("\n", timeout)  # The echo line only.
+        else:
+            reply = self.read_until_prompt(timeout)
+        self.check_reply(msg, reply)
+        self.print(reply)
+        return reply
+
+    def send_batch(self, commands: List[Tuple[str, str]], pipeline=False) -> List[str]:
+        """
+        Sends the commands one after the other, each waiting on its prompt.
+
+        With `pipeline`, all the commands are written at once and the replies
+        are split on the prompts. The instrument input buffer must be large
+        enough to hold the whole batch. Commands without prompt are not allowed.
+        """
+        if not pipeline:
+            return [self.send(command, value) for command, value in commands]
+
+        if any(command in NO_PROMPT_COMMANDS for command, _ in commands):
+            raise WizardError(f"{self.port}: {NO_PROMPT_COMMANDS} can not be pipelined.")
+
+        self.serial.write("".join(command + value + "\r" for command, value in commands).encode(ENCODING))
+        timeout = sum(COMMAND_TIMEOUTS.get(command, DEFAULT_TIMEOUT) for command, _ in commands)
+        replies = self.read_until_prompt(timeout, prompts=len(commands)).split(PROMPT)[:len(commands)]
+        for (command, value), reply in zip(commands, replies):
+            self.check_reply(command + value, reply)
+            self.print(reply)
+        return replies
 
     def set_serial_control(self, bauderate: int = 9600, parity: str = None, stop_bit: int = 1):
         """
@@ -54,7 +133,14 @@ class Wizard:
 
         value = str(bauderates.index(bauderate)) + str(parities.index(parity) + 1) + str(stop_bit)
 
-        self.send("CB", value)
+        if bauderate == self.serial.baudrate:
+            self.send("CB", value)
+        else:
+            # The reply comes at the new bauderate: switch and resync on the prompt.
+            self.serial.write(("CB" + value + "\r").encode(ENCODING))
+            self.serial.flush()
+            self.serial.baudrate = bauderate
+            self.wake_up()
 
     def set_flow_control(self, ens=1, ping=1, output=0, serial=0, record=1):
         """
@@ -127,43 +213,92 @@ class Wizard:
         self.serial.close()
 
 
-def pd8_test_setup(port, bauderate, new_bauderate = None):
+def pd8_test_setup(port, bauderate, new_bauderate=None, nbin=27, pipeline=False, verbose=True):
     start_time = (datetime.now() + timedelta(seconds=60)).strftime("%Y/%m/%d, %H:%M:%S")
 
-    w = Wizard(port=port, bauderate=bauderate)
-    w.enter_command_mode()
-
-    if new_bauderate is None:
-        new_bauderate = bauderate
+    w = Wizard(port=port, bauderate=bauderate, verbose=verbose)
+    try:
+        w.enter_command_mode()
+
+        # Always sent, as the serial settings may not be the defaults.
+        w.set_serial_control(bauderate=new_bauderate or bauderate, parity=None, stop_bit=1)
+
+        w.send_batch([
+            ("CF", "11111"),
+            # ("PD", "8"),
+            ("TT", datetime.now().strftime("%Y/%m/%d, %H:%M:%S")),
+            ("WN", f"{nbin:03d}"),
+            ("WP", f"{1:05d}"),
+            ("TP", "00:00.50"),
+            ("TE", "00:10:00.00"),
+            ("TG", start_time),
+        ], pipeline=pipeline)
+        w.keep_parameters()
+        w.deploy()
+    finally:
+        w.close()
 
-    w.set_serial_control(bauderate=new_bauderate, parity=None, stop_bit=1)
 
-    if new_bauderate != bauderate:
+def power_down(port, bauderate, verbose=True):
+    w = Wizard(port, bauderate, verbose=verbose)
+    try:
+        w.enter_command_mode()
+        w.power_down()
+    finally:
         w.close()
-        w = Wizard(port=port, bauderate=new_bauderate)
-
-    w.set_flow_control(ens=1, ping=1, output=1, serial=1, record=1)
-    #w.output_pd8()
-    w.set_real_time()
-    w.set_number_of_cells(27)
-    w.set_ping_per_ensemble(1)
-    w.set_time_between_pings("00:00.50")
-    w.set_time_between_ensemble("00:10:00.00")
-    w.set_start_time(start_time)
-    w.keep_parameters()
-    w.deploy()
-    w.close()
 
 
-def power_down(port, bauderate):
-    w = Wizard(port, bauderate)
-    w.enter_command_mode()
-    w.power_down()
-    w.close()
+def run_on_ports(func, ports: List[str], **kwargs) -> Dict[str, Exception]:
+    """Runs `func(port, **kwargs)` concurrently on every port. Returns the errors by port."""
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(ports))) as executor:
+        futures = {port: executor.submit(func, port, **kwargs) for port in ports}
+    for port, future in futures.items():
+        if future.exception() is not None:
+            errors[port] = future.exception()
+    return errors
+
+
+def _report(ports, errors, start):
+    """Exits with status 1 if an instrument failed, so deployments can be scripted."""
+    for port in ports:
+        if port in errors:
+            click.secho(f'{port}: {errors[port]}', fg='red')
+        else:
+            click.secho(f'{port}: done', fg='green')
+    click.echo(f'{len(ports) - len(errors)}/{len(ports)} instruments in {time.monotonic() - start:.1f}s')
+    if errors:
+        sys.exit(1)
+
+
+@click.group('wizard')
+def wizard():
+    pass
+
+
+@wizard.command('deploy')
+@click.argument('ports', nargs=-1, required=True)
+@click.option('-b', '--bauderate', type=click.INT, default=115200)
+@click.option('-n', '--new_bauderate', type=click.INT, default=None)
+@click.option('--nbin', type=click.INT, default=27)
+@click.option('-p', '--pipeline', is_flag=True, help='Write the settings batch at once.')
+@click.option('-q', '--quiet', is_flag=True)
+def deploy(ports, bauderate, new_bauderate, nbin, pipeline, quiet):
+    start = time.monotonic()
+    errors = run_on_ports(pd8_test_setup, list(ports), bauderate=bauderate, new_bauderate=new_bauderate,
+                          nbin=nbin, pipeline=pipeline, verbose=not quiet)
+    _report(ports, errors, start)
+
+
+@wizard.command('power_down')
+@click.argument('ports', nargs=-1, required=True)
+@click.option('-b', '--bauderate', type=click.INT, default=115200)
+@click.option('-q', '--quiet', is_flag=True)
+def _power_down(ports, bauderate, quiet):
+    start = time.monotonic()
+    errors = run_on_ports(power_down, list(ports), bauderate=bauderate, verbose=not quiet)
+    _report(ports, errors, start)
 
 
 if __name__ == "__main__":
-    PORT = "/dev/ttyUSB3"
-    current_bauderate = [115200, 19200][0]
-    pd8_test_setup(port=PORT, bauderate=current_bauderate, new_bauderate=115200)
-    #power_down(port=PORT, bauderate=current_bauderate)
+    wizard()
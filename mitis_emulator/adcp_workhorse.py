@@ -1,10 +1,17 @@
-import time
-import threading
-import serial
+import datetime
+import itertools
+import secrets
+from functools import lru_cache
+from typing import Iterator, List, Sequence
 
-from .logger import make_logger
+import numpy as np
 
-import logging
+from .attitude import AttitudeModel, CurrentProfile, EnsembleBlock, make_ensemble_block, BAD_VELOCITY
+from .cache import DataCache
+from .device import Device, check_interval
+from .fanout import FanOut
+from .outbound import OutboundQueue
+from .recorder import EnsembleRecorder, RECORDER_CAPACITY, records_block
 
 
 """
@@ -18,6 +25,17 @@ sends a carriage return line feed <CR> <LF> and displays a new “>” prompt.
 
 - Send to CE command to received last ensemble sampled.
 
+Emulated commands (`===` soft break instead of the BREAK signal):
+    ===        Stop pinging, enter command mode.
+    CS         Start pinging.
+    CE         Output the last recorded ensemble (PD8).
+    RS         Recorder space used / free (kB).
+    RY         Download the recorder. The ensembles are streamed in PD8,
+               oldest first, instead of the PD0 YMODEM transfer.
+    RE ErAsE   Erase the recorder.
+Other commands are acknowledged with a prompt. While pinging, only `===`
+is read.
+
 PD8 output format
 Newline CHARs terminate each line and two terminate a ensemble.
 
@@ -34,105 +52,320 @@ Bin    Dir    Mag     E/W     N/S    Vert     Err   Echo1  Echo2  Echo3  Echo4
 
 """
 
+DEFAULT_ATTITUDE = AttitudeModel()
+DEFAULT_PROFILE = CurrentProfile()
+
+
+class WorkHorse(Device):
+    __slots__ = ("sampling_rate", "attitude", "profile", "seed", "recorder", "receive_msg", "_block", "_block_index",
+                 "_ensemble_count", "_cache")
 
-class WorkHorse:
     beaudrate = 115200
     binary_format = 'ascii'
-    buffer_size = 3000
     number_of_bins = 25
-
-    def __init__(self, debug=False, sampling_rate=60):
-        self.sampling_rate = sampling_rate
-
-        log_level = logging.INFO
-        if debug is True:
-            log_level = logging.DEBUG
-
-        self.log = make_logger(self.__class__.__name__, level=log_level)
-
-        self.serial: serial.Serial = None
-        self.thread: threading.Thread = None
-
-        self._is_running = False
-
-        self.data_string = ""
-        self.make_data_string(nbin=self.number_of_bins)
+    # Ensembles computed per call to the attitude engine. 60 keeps ~95% of the
+    # batching gain of 600 (5.6 vs 4.7 us/ensemble) with a 10x smaller block
+    # held by every WorkHorse (13 vs 131 kB).
+    block_size = 60
+    frame_format = "pd8"
+    settings = ("sampling_rate", "attitude", "profile")
+    seeded = True
+    interval_setting = "sampling_rate"
+    prompt = "\r\n>"
+
+    # Received message (lower case) -> reply method. Shared by every WorkHorse.
+    COMMANDS = {
+        "cs": "start_pinging",
+        "ce": "last_ensemble",
+        "rs": "recorder_space",
+        "ry": "download",
+        "re erase": "erase",
+    }
+
+    def __init__(self, debug=False, sampling_rate=60, attitude: AttitudeModel = None, profile: CurrentProfile = None,
+                 recorder: str = None, recorder_capacity: int = RECORDER_CAPACITY, seed: int = None):
+        """
+        Parameters
+        ----------
+        seed :
+            Seed of the beam noise. The ensembles of two WorkHorse with the
+            same seed and models are identical. Random by default (logged).
+        recorder :
+            Memory-mapped file of the recorder, for long deployments. In
+            memory (`recorder_capacity` ensembles) by default.
+        """
+        super().__init__(debug=debug)
+        self.sampling_rate = check_interval(sampling_rate)
+        self.recorder = EnsembleRecorder(self.number_of_bins, capacity=recorder_capacity, path=recorder)
+        self.receive_msg = ""
+
+        # The default models are shared by every WorkHorse.
+        self.attitude = attitude or DEFAULT_ATTITUDE
+        self.profile = profile or DEFAULT_PROFILE
+        self.seed = secrets.randbits(63) if seed is None else seed
+        self._block: EnsembleBlock = None  # Last block computed, of index `_block_index`.
+        self._block_index = None
+        self._ensemble_count = 0
+        self._cache: np.ndarray = None  # Preloaded blocks (`preload`).
 
     @property
-    def is_running(self):
-        return self._is_running
-
-    def open_serial(self, port):
-        self.log.info(f'Opening port: {port}')
-
-        self.serial = serial.Serial()
-        self.serial.bytesize = serial.EIGHTBITS
-        self.serial.parity = serial.PARITY_NONE
-        self.serial.stopbits = serial.STOPBITS_ONE
-        self.serial.baudrate = self.beaudrate
-        self.serial.port = port
-
-        self.write_timeout=0
-
-        try:
-            self.serial.open()
-        except serial.serialutil.SerialException as err:
-            self.log.error(f'Ports {err}  does not exist')
-
-    def start(self, port):
-        self.open_serial(port)
-
-        if self.serial.is_open:
-            self._is_running = True
-            self.thread = threading.Thread(target=self.run, daemon=False)
-            self.thread.start()
-
-    def run(self):
-        self.log.info(f"Running ...")
-        self.log.info(f'Sample Interval: {self.sampling_rate}s')
-
-        while self._is_running:
-            self.send_data()
-            time.sleep(self.sampling_rate)
+    def is_pinging(self):
+        return self.is_ticking
+
+    def on_start(self):
+        self.log.info(f'Sample Interval: {self.sampling_rate}s, seed: {self.seed}')
+        self.start_ticking(delay=0)
+
+    def on_tick(self):
+        self.send_data()
+
+    @classmethod
+    def check_settings(cls, settings: dict) -> dict:
+        """`attitude` and `profile` are given as the `AttitudeModel` and `CurrentProfile` (numeric) parameters."""
+        settings = super().check_settings(settings)
+        for name, model in (("attitude", AttitudeModel), ("profile", CurrentProfile)):
+            if isinstance(settings.get(name), dict):
+                settings[name] = model(**{k: float(v) for k, v in settings[name].items()})
+        return settings
+
+    def configure(self, **settings):
+        super().configure(**settings)
+        if "attitude" in settings or "profile" in settings or "sampling_rate" in settings:
+            # Ensembles computed with the previous models.
+            self._block = None
+            self._cache = None
+
+    def frames(self, n: int) -> List[bytes]:
+        """The ensembles are formatted all at once (not recorded)."""
+        numbers = self._ensemble_count + 1 + np.arange(n)
+        now = datetime.datetime.now()
+        timestamps = [now + datetime.timedelta(seconds=s) for s in (np.arange(n) * self.sampling_rate).tolist()]
+        block = self.next_ensembles(n=n, nbin=self.number_of_bins)
+        return [e + b"\n\n" for e in pd8_ensembles(timestamps, numbers.tolist(), block)]
+
+    def on_bytes(self, data: bytes):
+        buff = data.decode(self.binary_format, errors='replace')
+        self.log.debug(f'Buffer: {buff}')
+
+        if self.is_pinging:
+            # Only the soft break is read.
+            self.receive_msg = (self.receive_msg + buff)[-3:]
+            if self.receive_msg == "===":
+                self.receive_msg = ""
+                self.soft_break()
+            return
+
+        *messages, self.receive_msg = (self.receive_msg + buff).split("\r")
+        for msg in messages:
+            self.on_message(msg.strip())
+
+    def on_message(self, msg: str):
+        self.log.info(f'Message received: {msg}')
+        reply = self.COMMANDS.get(msg.lower())
+        if reply is None:
+            self.reply(msg)
+        else:
+            getattr(self, reply)(msg)
+
+    def reply(self, msg: str, text: str = None):
+        """Echoes `msg`, sends `text` (if any) and the prompt."""
+        if text:
+            msg += "\r\n" + text
+        self.write((msg + self.prompt).encode(self.binary_format))
+
+    def soft_break(self):
+        self.stop_ticking()
+        self.log.info('Break: command mode.')
+        self.write(f"\r\n[BREAK Wakeup A]\r\nWorkHorse Broadband ADCP Version 50.40\r\n"
+                   f"Teledyne RD Instruments (c) 1996-2010{self.prompt}".encode(self.binary_format))
+
+    def start_pinging(self, msg: str):
+        self.write(f"{msg}\r\n".encode(self.binary_format))
+        self.log.info('Pinging.')
+        self.start_ticking(delay=0)
+
+    def last_ensemble(self, msg: str):
+        """In verification mode, the reply is a data frame: tagged with the next sequence number."""
+        last = self.recorder.last()
+        if last is None:
+            self.reply(msg, "ERR: No ensemble recorded.")
+            return
+        ensemble = self._pd8(last).decode(self.binary_format)[:-2]
+        self.reply(msg, self.tag(ensemble) + "\n\n")
+
+    def recorder_space(self, msg: str):
+        used = self.recorder.nbytes
+        free = (self.recorder.capacity - len(self.recorder)) * self.recorder.dtype.itemsize
+        self.reply(msg, f"RS = {used // 1024:d},{free // 1024:d} ---- RECORDER SPACE used/free (kB)")
+
+    def download(self, msg: str):
+        """Streamed on the serial port, by blocks of ensembles, as fast as the port is drained."""
+        self.log.info(f'Downloading {len(self.recorder)} ensembles')
+        self.stream(itertools.chain(
+            [f"{msg}\r\n".encode(self.binary_format)],
+            self._download_chunks(),
+            [b">"],
+        ))
+
+    def _download_chunks(self) -> Iterator[bytes]:
+        for records in self.recorder.chunks():
+            yield self._pd8(records)
+
+    def _pd8(self, records: np.ndarray) -> bytes:
+        """Recorded ensembles in PD8, with their two newline terminators."""
+        timestamps = [datetime.datetime.fromtimestamp(t) for t in records["time"].tolist()]
+        return b"".join(e + b"\n\n" for e in pd8_ensembles(timestamps, records["number"].tolist(),
+                                                           records_block(records)))
+
+    def erase(self, msg: str):
+        self.recorder.clear()
+        self.reply(msg)
 
     def send(self, msg: str, end_char=True):
         if end_char:
             msg += "\n\n"
         self.log.info("```" + msg + "```")
-        self.serial.write(msg.encode(self.binary_format))
-        # self.log.info(rf'`{msg}` sent')
+        self.write(msg.encode(self.binary_format))
 
     def send_data(self):
         self.log.info(f'Sampled sent. (Interval: {self.sampling_rate}s)')
-        self.send(self.data_string, end_char=True)
+        self.make_data_string(nbin=self.number_of_bins)
+        self.send(self.tag(self.data_string), end_char=True)
+
+    def next_ensembles(self, n=1, nbin=25) -> EnsembleBlock:
+        """Returns the next `n` ensembles."""
+        block = self.ensembles(self._ensemble_count, n, nbin)
+        self._ensemble_count += n
+        return block
+
+    def ensembles(self, first: int, n: int, nbin=25) -> EnsembleBlock:
+        """Ensembles `first` to `first + n` (0-based), from the blocks covering them."""
+        size = self.block_size
+        blocks = [self.ensemble_block(k, nbin) for k in range(first // size, (first + n - 1) // size + 1)]
+        block = blocks[0] if len(blocks) == 1 else EnsembleBlock.concatenate(blocks)
+        start = first % size
+        return block[start:start + n]
+
+    def ensemble_block(self, k: int, nbin=25) -> EnsembleBlock:
+        """
+        Ensembles `k * block_size` to `(k + 1) * block_size`, computed at once
+        by the attitude engine.
+
+        The beam noise of every block has its own random stream, seeded by
+        (`seed`, `k`): a block is the same whichever order, and however many
+        times, it is computed, so it can be cached.
+        """
+        if self._block is not None and self._block_index == k and self._block.velocity.shape[1] == nbin:
+            return self._block
+        size = self.block_size
+        cache = self._cache
+        if cache is not None and (k + 1) * size <= len(cache) and cache.dtype["velocity"].shape[0] == nbin:
+            block = EnsembleBlock.from_records(cache[k * size:(k + 1) * size])
+        else:
+            t = (k * size + np.arange(size)) * self.sampling_rate
+            rng = np.random.default_rng([self.seed, k])
+            block = make_ensemble_block(t, nbin, self.attitude, self.profile, rng=rng)
+        self._block, self._block_index = block, k
+        return block
+
+    def cache_parameters(self, nbin: int, blocks: int) -> dict:
+        """Everything the first `blocks` blocks depend on."""
+        return {
+            "data": "workhorse_ensembles",
+            "seed": self.seed,
+            "nbin": nbin,
+            "blocks": blocks,
+            "block_size": self.block_size,
+            "sampling_rate": self.sampling_rate,
+            "attitude": vars(self.attitude),
+            "profile": vars(self.profile),
+        }
+
+    def preload(self, cache: DataCache, n: int) -> int:
+        """
+        Maps the first `n` ensembles from `cache`, computing and storing them
+        if missing. Restarted devices (same seed and models) reuse them
+        without computation. Dropped when the models change (`configure`).
+        Returns the bytes mapped.
+        """
+        blocks = -(-n // self.block_size)
+        nbin = self.number_of_bins
+        self._cache = None
+        self._cache = cache.get_or_create(self.cache_parameters(nbin, blocks),
+                                          lambda: self.ensembles(0, blocks * self.block_size, nbin).to_records())
+        return self._cache.nbytes
+
+    def make_data_string(self, nbin=25, timestamp: datetime.datetime = None):
+        """The ensemble is recorded (if it has `number_of_bins` bins)."""
+        number = self._ensemble_count + 1
+        timestamp = timestamp or datetime.datetime.now()
+        block = self.next_ensembles(n=1, nbin=nbin)
+        if nbin == self.recorder.nbin:
+            self.recorder.append(timestamp.timestamp(), number, block)
+        self.data_string = pd8_ensembles([timestamp], [number], block)[0].decode(self.binary_format)
 
     def close(self):
-        self.log.info('Closing Serial')
-        self._is_running = False
-
-        self.log.info('Waiting for thread ...')
-        self.thread.join()
-
-        self.serial.close()
-        self.log.info('Serial Closed')
-
-    def make_data_string(self, nbin=25):
-        _sample = [
-            "2023/09/27 12:33:00.00 00016",
-            "Hdg: 330.8 Pitch: 0.1 Roll: 0.5",
-            "Temp: 23.9 SoS: 1528 BIT: 00",
-            "Bin    Dir    Mag     E/W     N/S    Vert     Err   Echo1  Echo2  Echo3  Echo4",
-        ]
-        for i in range(nbin):
-            # _sample.append(f" {i+1} -- -- -32768 -32768 -32768 -32768 43 49     46      43")
-            _sample.append(f" {i+1:>2}    --      --  -32768  -32768  -32768  -32768     40     46     43     41")
-
-        self.data_string = "\n".join(_sample)
-
-
-def start_workhorse(port: str, sampling_rate=int, debug=False):
-    workhorse = WorkHorse(debug=debug, sampling_rate=sampling_rate)
-    workhorse.start(port=port)
+        super().close()
+        self.recorder.flush()
+
+
+PD8_COLUMNS = "Bin    Dir    Mag     E/W     N/S    Vert     Err   Echo1  Echo2  Echo3  Echo4"
+PD8_ROW = "{:>3}    --      --  {:>6}  {:>6}  {:>6}  {:>6}     40     46     43     41\n"
+PD8_VELOCITY_COLUMNS = (19, 27, 35, 43)  # Offsets of E/W, N/S, Vert, Err in a PD8 row.
+
+
+@lru_cache()
+def _pd8_digits() -> np.ndarray:
+    """Right aligned ascii of every int16, indexed by `value - BAD_VELOCITY`."""
+    table = np.array([f"{v:>6}" for v in range(BAD_VELOCITY, -BAD_VELOCITY)], dtype="S6")
+    return table.view(np.uint8).reshape(-1, 6)
+
+
+@lru_cache()
+def _pd8_rows_template(nbin: int) -> np.ndarray:
+    rows = "".join(PD8_ROW.format(i + 1, *[BAD_VELOCITY] * 4) for i in range(nbin))
+    return np.frombuffer(rows.encode('ascii'), dtype=np.uint8).reshape(nbin, -1)
+
+
+def pd8_ensembles(timestamps: Sequence[datetime.datetime], numbers: Sequence[int], block: EnsembleBlock) -> List[bytes]:
+    """
+    Formats a block of ensembles in PD8. The ensembles are returned without
+    their two newline terminator.
+
+    The bins rows are fixed width, so they are formatted all at once by
+    writing the velocities digits in a rows template.
+    """
+    n, nbin = block.velocity.shape[:2]
+
+    rows = np.empty((n,) + _pd8_rows_template(nbin).shape, dtype=np.uint8)
+    rows[:] = _pd8_rows_template(nbin)
+    digits = _pd8_digits()[block.velocity.astype(np.int32) - BAD_VELOCITY]  # (n, nbin, 4, 6)
+    for k, offset in enumerate(PD8_VELOCITY_COLUMNS):
+        rows[:, :, offset:offset + 6] = digits[:, :, k]
+    rows = rows.reshape(n, -1)
+
+    ensembles = []
+    for i, (timestamp, number, heading, pitch, roll) in enumerate(
+            zip(timestamps, numbers, block.heading.tolist(), block.pitch.tolist(), block.roll.tolist())):
+        header = (
+            f"{timestamp:%Y/%m/%d %H:%M:%S}.{timestamp.microsecond // 10_000:02d} {number % 100_000:05d}\n"
+            f"Hdg: {heading:.1f} Pitch: {pitch:.1f} Roll: {roll:.1f}\n"
+            f"Temp: 23.9 SoS: 1528 BIT: 00\n"
+            f"{PD8_COLUMNS}\n"
+        )
+        ensembles.append(header.encode('ascii') + rows[i, :-1].tobytes())
+
+    return ensembles
+
+
+def start_workhorse(port: str, sampling_rate=int, debug=False, fanout: FanOut = None,
+                    outbound: OutboundQueue = None, recorder: str = None, recorder_capacity: int = None,
+                    verify=False, seed: int = None):
+    workhorse = WorkHorse(debug=debug, sampling_rate=sampling_rate, recorder=recorder,
+                          recorder_capacity=recorder_capacity or RECORDER_CAPACITY, seed=seed)
+    if verify:
+        workhorse.enable_verification()
+    workhorse.start(port=port, fanout=fanout, outbound=outbound)
 
     return workhorse
 
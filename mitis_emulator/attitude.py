@@ -0,0 +1,215 @@
+"""
+Attitude model and beam-to-earth transform for the WorkHorse emulator.
+
+Notes
+-----
+The instrument attitude is a slow heading swing (mooring rotating with the
+tide) plus pitch and roll oscillations (wave motion). Heading, pitch and roll
+are applied as intrinsic ZXY rotations (heading about Z, pitch about X, roll
+about Y, the RDI convention), giving the instrument -> earth rotation of
+every ensemble. Note that `misc/rotation_angle_demo.py` plots ZYX rotations.
+
+For a block of ensembles the synthetic earth water velocities are:
+    earth -> instrument (inverse rotation)
+          -> beam       (Janus geometry, with beam noise)
+          -> instrument (standard RDI beam matrix, gives the error velocity)
+          -> earth      (rotation)
+so the E/W, N/S, Vert and Err columns are consistent with the attitude line.
+
+Everything is computed with numpy arrays from one batched `Rotation` per
+block of ensembles, never per ensemble or per bin.
+"""
+
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+BEAM_ANGLE = 20  # degrees, WorkHorse Janus configuration.
+BAD_VELOCITY = -32768  # PD8 value for missing velocities.
+TIDAL_PERIOD = 44_712  # M2 period in seconds.
+
+
+def beam_to_instrument_matrix(beam_angle: float = BEAM_ANGLE) -> np.ndarray:
+    """RDI beam to instrument (X, Y, Z, Err) matrix for a convex transducer."""
+    theta = np.deg2rad(beam_angle)
+    a = 1 / (2 * np.sin(theta))
+    b = 1 / (4 * np.cos(theta))
+    d = a / np.sqrt(2)
+    return np.array([
+        [a, -a, 0, 0],
+        [0, 0, -a, a],
+        [b, b, b, b],
+        [d, d, -d, -d],
+    ])
+
+
+BEAM_TO_INSTRUMENT = beam_to_instrument_matrix()
+INSTRUMENT_TO_BEAM = np.linalg.pinv(BEAM_TO_INSTRUMENT[:3])
+
+
+@dataclass
+class EnsembleBlock:
+    """
+    heading, pitch, roll: (n,) degrees
+    velocity: (n, nbin, 4) E/W, N/S, Vert, Err in mm/s
+    """
+    heading: np.ndarray
+    pitch: np.ndarray
+    roll: np.ndarray
+    velocity: np.ndarray
+
+    def __len__(self):
+        return len(self.heading)
+
+    def __getitem__(self, item: slice) -> "EnsembleBlock":
+        return EnsembleBlock(self.heading[item], self.pitch[item], self.roll[item], self.velocity[item])
+
+    @staticmethod
+    def concatenate(blocks: List["EnsembleBlock"]) -> "EnsembleBlock":
+        return EnsembleBlock(*(np.concatenate([getattr(b, f) for b in blocks]) for f in ("heading", "pitch", "roll",
+                                                                                           "velocity")))
+
+    def to_records(self) -> np.ndarray:
+        """Structured array (heading, pitch, roll, velocity), e.g. to be cached."""
+        nbin = self.velocity.shape[1]
+        records = np.empty(len(self), dtype=[("heading", "<f8"), ("pitch", "<f8"), ("roll", "<f8"),
+                                             ("velocity", "<i2", (nbin, 4))])
+        records["heading"], records["pitch"], records["roll"] = self.heading, self.pitch, self.roll
+        records["velocity"] = self.velocity
+        return records
+
+    @staticmethod
+    def from_records(records: np.ndarray) -> "EnsembleBlock":
+        """Views on the fields of `records` (no copy)."""
+        return EnsembleBlock(records["heading"], records["pitch"], records["roll"], records["velocity"])
+
+
+class AttitudeModel:
+    """Heading swing and pitch/roll motion of the instrument."""
+
+    def __init__(
+            self,
+            heading: float = 330.8,
+            heading_swing: float = 20,
+            heading_period: float = TIDAL_PERIOD,
+            pitch: float = 0.1,
+            roll: float = 0.5,
+            pitch_amplitude: float = 2,
+            roll_amplitude: float = 3,
+            motion_period: float = 8,
+    ):
+        self.heading = heading
+        self.heading_swing = heading_swing
+        self.heading_period = heading_period
+        self.pitch = pitch
+        self.roll = roll
+        self.pitch_amplitude = pitch_amplitude
+        self.roll_amplitude = roll_amplitude
+        self.motion_period = motion_period
+
+    def attitude(self, t: np.ndarray):
+        """Returns heading, pitch and roll (degrees) at times `t` (seconds)."""
+        t = np.asarray(t, dtype=float)
+        phase = 2 * np.pi * t / self.motion_period
+        heading = (self.heading + self.heading_swing * np.sin(2 * np.pi * t / self.heading_period)) % 360
+        pitch = self.pitch + self.pitch_amplitude * np.sin(phase)
+        roll = self.roll + self.roll_amplitude * np.sin(phase + np.pi / 3)
+        return heading, pitch, roll
+
+    @staticmethod
+    def rotations(heading: np.ndarray, pitch: np.ndarray, roll: np.ndarray) -> Rotation:
+        """Instrument -> earth rotations. Heading is clockwise from North."""
+        return Rotation.from_euler("ZXY", np.column_stack([-heading, pitch, roll]), degrees=True)
+
+
+class CurrentProfile:
+    """Tidal current veering and decaying with range from the instrument."""
+
+    def __init__(
+            self,
+            speed: float = 0.3,
+            direction: float = 45,
+            tidal_period: float = TIDAL_PERIOD,
+            shear: float = 0.02,
+            veer: float = 2,
+            vertical: float = 0.005,
+    ):
+        """
+        Parameters
+        ----------
+        speed :
+            Surface speed (m/s).
+        direction :
+            Flood direction (degrees clockwise from North).
+        shear :
+            Fractional speed loss per bin.
+        veer :
+            Direction change per bin (degrees).
+        vertical :
+            Vertical velocity amplitude (m/s).
+        """
+        self.speed = speed
+        self.direction = direction
+        self.tidal_period = tidal_period
+        self.shear = shear
+        self.veer = veer
+        self.vertical = vertical
+
+    def velocity(self, t: np.ndarray, nbin: int) -> np.ndarray:
+        """Returns earth velocities (East, North, Up) in m/s. Shape: (n, nbin, 3)."""
+        t = np.asarray(t, dtype=float)[:, None]
+        bins = np.arange(nbin)[None, :]
+        tide = np.cos(2 * np.pi * t / self.tidal_period)
+        speed = self.speed * tide * np.clip(1 - self.shear * bins, 0, None)
+        direction = np.deg2rad(self.direction + self.veer * bins)
+        return np.stack([
+            speed * np.sin(direction),
+            speed * np.cos(direction),
+            np.broadcast_to(self.vertical * np.sin(2 * np.pi * t / 600), speed.shape),
+        ], axis=-1)
+
+
+def make_ensemble_block(
+        t: np.ndarray,
+        nbin: int,
+        attitude: AttitudeModel,
+        profile: CurrentProfile,
+        beam_noise: float = 0.01,
+        rng: np.random.Generator = None,
+) -> EnsembleBlock:
+    """
+    Computes a block of ensembles at times `t` (seconds).
+
+    Parameters
+    ----------
+    beam_noise :
+        Standard deviation of the along beam velocity noise (m/s). It is what
+        makes the error velocity non-zero.
+    """
+    rng = rng or np.random.default_rng()
+
+    heading, pitch, roll = attitude.attitude(t)
+    matrices = attitude.rotations(heading, pitch, roll).as_matrix()  # (n, 3, 3)
+
+    # Per ensemble composite matrices, so the per bin work is two small products.
+    earth_to_beam = INSTRUMENT_TO_BEAM @ matrices.transpose(0, 2, 1)  # (n, 4, 3)
+    beam_to_earth = np.zeros((len(matrices), 4, 4))
+    beam_to_earth[:, :3] = matrices @ BEAM_TO_INSTRUMENT[:3]
+    beam_to_earth[:, 3] = BEAM_TO_INSTRUMENT[3]
+
+    beam = profile.velocity(t, nbin) @ earth_to_beam.transpose(0, 2, 1)  # (n, nbin, 4)
+    beam += rng.normal(0, beam_noise, beam.shape)
+    velocity = beam @ beam_to_earth.transpose(0, 2, 1)
+
+    velocity *= 1000  # mm/s
+    np.rint(velocity, out=velocity)
+    np.clip(velocity, BAD_VELOCITY + 1, -BAD_VELOCITY - 1, out=velocity)
+
+    return EnsembleBlock(
+        heading=heading,
+        pitch=pitch,
+        roll=roll,
+        velocity=velocity.astype(np.int16),
+    )
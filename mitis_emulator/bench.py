@@ -0,0 +1,91 @@
+"""
+Memory measurement of the emulated devices.
+
+For every device type and count, the devices are created and the growth of
+the process RSS and of the python heap (tracemalloc) is reported per device.
+RSS is measured without tracemalloc running, since it inflates it.
+"""
+
+import gc
+import logging
+import os
+import resource
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+import serial
+
+from .adcp_workhorse import WorkHorse
+from .gps import GPS
+from .sbe37 import SBE37
+
+DEVICES: Dict[str, Callable] = {"sbe37": SBE37, "workhorse": WorkHorse, "gps": GPS}
+
+
+@dataclass
+class MemoryResult:
+    device: str
+    count: int
+    rss_per_device: float  # bytes
+    traced_per_device: float  # bytes
+
+
+def rss() -> int:
+    """Current resident set size (bytes). Falls back on the peak RSS off Linux."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_devices(name: str, count: int, with_serial=False, warm=False) -> list:
+    """
+    Parameters
+    ----------
+    with_serial :
+        Give every device a (closed) `serial.Serial`.
+    warm :
+        Make a first data string, as a streaming device would have.
+    """
+    devices = []
+    for _ in range(count):
+        device = DEVICES[name]()
+        if with_serial:
+            device.serial = serial.Serial()
+        if warm:
+            device.make_data_string()
+        devices.append(device)
+    return devices
+
+
+def measure(name: str, count: int, with_serial=False, warm=False) -> MemoryResult:
+    gc.collect()
+    before = rss()
+    devices = make_devices(name, count, with_serial=with_serial, warm=warm)
+    gc.collect()
+    rss_growth = rss() - before
+    del devices
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    devices = make_devices(name, count, with_serial=with_serial, warm=warm)
+    traced_growth = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del devices
+
+    return MemoryResult(name, count, rss_growth / count, traced_growth / count)
+
+
+def memory_bench(names: List[str], counts: List[int], with_serial=False, warm=False) -> List[MemoryResult]:
+    logging.disable(logging.INFO)
+    try:
+        # Shared templates and tables are built once, before measuring.
+        for name in names:
+            make_devices(name, 1, with_serial=with_serial, warm=True)
+
+        return [measure(name, count, with_serial=with_serial, warm=warm) for name in names for count in counts]
+    finally:
+        logging.disable(logging.NOTSET)
@@ -0,0 +1,118 @@
+"""
+On-disk cache of precomputed synthetic data.
+
+Arrays are stored as `.npy` files named by the sha256 of their generator
+parameters (seed included), and loaded memory-mapped (read-only): devices
+with the same data share the pages, and a restart reuses them instantly.
+
+The cache is bounded to `max_bytes`: least recently used files (by
+modification time, refreshed on every hit) are evicted. Files are written
+to a temporary name then renamed, so concurrent processes never load a
+partial file.
+
+Synthetic data is made reproducible by deriving every random stream from a
+seed (`derive_seed`), so cached and recomputed data are bit-for-bit equal.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from .logger import make_logger
+
+CACHE_VERSION = 1  # Bump when the generators change: older entries are not reused.
+CACHE_DIRECTORY = Path(os.getenv("XDG_CACHE_HOME") or Path.home().joinpath(".cache")).joinpath("mitis")
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+
+def derive_seed(seed: int, *keys) -> int:
+    """Independent seed for `keys` (e.g. a device name), from the `seed` of a run."""
+    digest = hashlib.sha256(json.dumps([seed, *keys]).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") >> 1
+
+
+class DataCache:
+    def __init__(self, directory: str = CACHE_DIRECTORY, max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.log = make_logger("DataCache")
+
+    @staticmethod
+    def key(params: dict) -> str:
+        """Content address of the data generated with `params` (json serializable)."""
+        canonical = json.dumps(dict(params, cache_version=CACHE_VERSION), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory.joinpath(key[:2], f"{key}.npy")
+
+    def get(self, params: dict) -> np.ndarray:
+        """Memory-mapped array, or None if not cached."""
+        path = self.path(self.key(params))
+        try:
+            array = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        except ValueError as err:
+            self.log.warning(f'Corrupted cache entry {path} removed: {err}')
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)  # Most recently used.
+        return array
+
+    def put(self, params: dict, array: np.ndarray) -> np.ndarray:
+        """Stores `array`. Returns it memory-mapped from the cache."""
+        path = self.path(self.key(params))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        self.evict(keep=path)
+        return np.load(path, mmap_mode="r")
+
+    def get_or_create(self, params: dict, build: Callable[[], np.ndarray]) -> np.ndarray:
+        array = self.get(params)
+        if array is None:
+            array = self.put(params, build())
+        return array
+
+    def entries(self) -> List[Tuple[float, int, Path]]:
+        """(mtime, size, path) of the entries, least recently used first."""
+        entries = []
+        for path in self.directory.glob("*/*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # Evicted by another process.
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep: Path = None):
+        """Removes the least recently used entries until the cache fits in `max_bytes`."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            self.log.info(f'Evicted {path.name} ({size / 1024 ** 2:.1f} MiB)')
+
+    def clear(self):
+        for _, _, path in self.entries():
+            path.unlink(missing_ok=True)
@@ -0,0 +1,122 @@
+"""
+Devices configuration and its hot reload.
+
+The configuration (`mitis_config.json`) describes the devices by name:
+
+```
+{
+  "devices": {
+    "ctd_1": {"type": "sbe37", "port": "/dev/ttyUSB0", "low_salinity": false},
+    "adcp_1": {"type": "workhorse", "port": "/dev/ttyUSB1", "sampling_rate": 60,
+               "profile": {"speed": 0.5}},
+    "gps": {"type": "gps", "port": "/dev/ttyUSB2"}
+  }
+}
+```
+`type` is `sbe37`, `workhorse`, `gps` or a protocol definition (see
+`protocol.py`). The other keys are either live settings of the device
+(`Device.settings`, applied without restart) or constructor parameters
+(the device is restarted when they change). Devices without port are not
+started. The original `ports` and `workhorse_sampling_rate_s` keys are
+still read, as the `sbe37` and `workhorse` devices.
+
+Reproducible data and fast restarts:
+
+```
+{
+  "seed": 1234,
+  "cache": {"directory": "~/.cache/mitis", "max_mb": 2048},
+  "devices": {"adcp_1": {"type": "workhorse", "port": "/dev/ttyUSB1", "preload": 86400}}
+}
+```
+Devices with random data (`Device.seeded`) get their own seed derived from
+`seed` and their name, unless given one. `preload` ensembles are mapped
+from the data cache (see `cache.py`) before the device starts, computed
+only on the first run. Without `seed`, the data would be cached under a
+random seed, never reused: `preload` is ignored. Every device has its own
+entry, so `max_mb` must hold the data preloaded by the whole fleet (a day of
+25 bins ensembles is ~19 MB per WorkHorse: ~10 GB for 500); a warning is
+logged otherwise, as entries would be evicted and computed again.
+
+`ConfigWatcher` polls the configuration file modification time (the
+standard library has no inotify binding) and calls back with the new
+configuration when it changes.
+"""
+
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from .logger import make_logger
+
+DEVICE_KEYS = ("type", "port", "verify", "preload")  # Not passed to the device.
+
+
+def device_specs(configuration: dict) -> Dict[str, dict]:
+    """Device name: spec. Devices without port are left out."""
+    specs = {}
+    ports = configuration.get("ports", {})
+    if ports.get("sbe37"):
+        specs["sbe37"] = {"type": "sbe37", "port": ports["sbe37"]}
+    if ports.get("workhorse"):
+        specs["workhorse"] = {"type": "workhorse", "port": ports["workhorse"]}
+        if "workhorse_sampling_rate_s" in configuration:
+            specs["workhorse"]["sampling_rate"] = configuration["workhorse_sampling_rate_s"]
+
+    for name, spec in configuration.get("devices", {}).items():
+        if spec.get("port"):
+            specs[name] = dict(spec)
+    return specs
+
+
+def diff_specs(running: Dict[str, dict], specs: Dict[str, dict]) -> Tuple[List[str], List[str], List[str]]:
+    """Names of the devices removed, added and changed."""
+    removed = [name for name in running if name not in specs]
+    added = [name for name in specs if name not in running]
+    changed = [name for name in specs if name in running and specs[name] != running[name]]
+    return removed, added, changed
+
+
+class ConfigWatcher:
+    def __init__(self, path: str, callback: Callable[[dict], object], interval: float = 1.):
+        self.path = str(path)
+        self.callback = callback
+        self.interval = interval
+        self.log = make_logger("ConfigWatcher")
+        self._stop = threading.Event()
+        self._stamp = self.stamp()
+        self.thread = threading.Thread(target=self.run, name="config-watcher", daemon=True)
+
+    def stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self):
+        self.log.info(f'Watching {self.path}')
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            stamp = self.stamp()
+            if stamp == self._stamp or stamp is None:
+                continue
+            self._stamp = stamp
+            try:
+                with open(self.path) as f:
+                    configuration = json.load(f)
+            except ValueError as err:
+                # Partially written, or invalid: the running state is kept.
+                self.log.error(f'Invalid configuration {self.path}: {err}')
+                continue
+            self.log.info(f'Configuration changed: {self.path}')
+            try:
+                self.callback(configuration)
+            except Exception as err:
+                self.log.error(f'Configuration not applied: {err}')
@@ -0,0 +1,347 @@
+"""
+Base of the emulated devices.
+
+A device is a compact object (`__slots__`, templates and command tables
+shared at the class level) driven by callbacks from a `Runtime`:
+    on_start:    the device was added to the runtime, schedule its timers.
+    on_readable: bytes are waiting on its serial port.
+    on_tick:     periodic output, every `interval` seconds while ticking
+                 (`start_ticking`, `stop_ticking`).
+
+`start(port)` runs the device on the process wide runtime thread, shared by
+every device started this way. A device can also be added to a given runtime:
+`start(port, runtime=runtime)`.
+
+Writes never block: frames go through a bounded outbound queue drained with
+non-blocking writes when the port is writable (see `outbound.py`). Bulk
+replies (memory uploads) are streamed with `stream(chunks)`: the chunks are
+pulled only when the queue is drained, as fast as the link allows. Frames
+written during a stream are held and queued after it, so they never
+interleave with it.
+
+In verification mode (`enable_verification`), data frames are tagged with a
+sequence number and a checksum (see `verify.py`).
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Iterator, List, Tuple
+
+import serial
+
+from .fanout import FanOut, BLOCK
+from .logger import make_logger
+from .outbound import OutboundQueue, DROP_NEWEST
+from .runtime import Runtime, acquire_shared_runtime, release_shared_runtime
+from .verify import FRAME_FORMATS
+
+
+def check_interval(value) -> float:
+    """`value` in seconds, as a float. Raises ValueError unless > 0: a null interval would spin the runtime."""
+    interval = float(value)
+    if not interval > 0:
+        raise ValueError(f'Interval must be > 0 seconds, not {value}.')
+    return interval
+
+
+class Device:
+    __slots__ = ("log", "serial", "fanout", "runtime", "outbound", "_is_running", "_write_blocked", "_shared_runtime",
+                 "_stream", "_stream_buffer", "_held", "sequence", "data_string", "_next_tick")
+
+    beaudrate = 19_200
+    timeout = .1
+    binary_format = 'ascii'
+    reads = True  # Whether the device reads its serial port (commands).
+    outbound_size = 64 * 1024  # bytes
+    overflow_policy = DROP_NEWEST
+    frame_format: str = None  # Verification frame format (`verify.FRAME_FORMATS`).
+    settings: Tuple[str, ...] = ()  # Settings applied live by `configure` (hot reload).
+    seeded = False  # Takes a `seed` parameter making its (random) data reproducible.
+    interval_setting: str = None  # Attribute of the seconds between periodic outputs (`on_tick`).
+
+    def __init__(self, debug=False):
+        log_level = logging.INFO
+        if debug is True:
+            log_level = logging.DEBUG
+
+        self.log = make_logger(self.__class__.__name__, level=log_level)
+
+        self.serial: serial.Serial = None
+        self.fanout: FanOut = None
+        self.runtime: Runtime = None
+        self.outbound: OutboundQueue = None
+
+        self._is_running = False
+        self._write_blocked = False
+        self._shared_runtime = False
+        self._stream = None
+        self._stream_buffer = b""
+        self._held: OutboundQueue = None  # Frames written during a stream.
+        self.sequence: int = None  # Last data frame sequence number. None when not verifying.
+
+        self.data_string = ""
+        self._next_tick: float = None  # Deadline of the next periodic output. None when stopped.
+
+    @property
+    def is_running(self):
+        return self._is_running
+
+    def open_serial(self, port):
+        self.log.info(f'Opening port: {port}')
+
+        self.serial = serial.Serial()
+        self.serial.bytesize = serial.EIGHTBITS
+        self.serial.parity = serial.PARITY_NONE
+        self.serial.stopbits = serial.STOPBITS_ONE
+        self.serial.baudrate = self.beaudrate
+        self.serial.timeout = self.timeout
+        self.serial.port = port
+
+        try:
+            self.serial.open()
+        except serial.serialutil.SerialException as err:
+            self.log.error(f'Ports {err}  does not exist')
+
+    def start(self, port, fanout: FanOut = None, runtime: Runtime = None, outbound: OutboundQueue = None):
+        """
+        Parameters
+        ----------
+        fanout :
+            If given, frames are published to `fanout` and the serial port is
+            one of its (lossless) subscribers.
+        runtime :
+            Runtime running the device. By default, the process wide runtime
+            (started with the first device, stopped with the last).
+        outbound :
+            Outbound queue of the serial port. Defaults to `outbound_size` bytes
+            with the `overflow_policy`.
+        """
+        self.open_serial(port)
+
+        if self.serial.is_open:
+            self.outbound = outbound or OutboundQueue(self.outbound_size, self.overflow_policy)
+            if fanout is not None:
+                self.fanout = fanout
+                self.fanout.subscribe(port, self.queue, policy=BLOCK)
+            self._is_running = True
+            if runtime is None:
+                runtime = acquire_shared_runtime()
+                self._shared_runtime = True
+            self.runtime = runtime
+            self.runtime.add(self)
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def on_start(self):
+        """Called by the runtime once the device is added."""
+
+    @classmethod
+    def check_settings(cls, settings: dict) -> dict:
+        """
+        `settings` validated and converted for `configure`. Raises ValueError
+        or TypeError if invalid. Thread safe: a configuration is checked before
+        it is handed to the runtime thread.
+        """
+        checked = {}
+        for name, value in settings.items():
+            if name not in cls.settings:
+                raise ValueError(f'{cls.__name__}: `{name}` is not a live setting.')
+            checked[name] = check_interval(value) if name == cls.interval_setting else value
+        return checked
+
+    def configure(self, **settings):
+        """Applies `settings` (in `self.settings`) live. Runtime thread only, once started."""
+        for name, value in self.check_settings(settings).items():
+            setattr(self, name, value)
+        if self.interval_setting in settings:
+            self.reschedule()
+
+    @property
+    def interval(self) -> float:
+        return getattr(self, self.interval_setting)
+
+    @property
+    def is_ticking(self):
+        return self._next_tick is not None
+
+    def start_ticking(self, delay: float = None):
+        """Calls `on_tick` every `interval` seconds, first after `delay` (default: `interval`). Runtime thread only."""
+        self._schedule_tick(time.monotonic() + (self.interval if delay is None else delay))
+
+    def stop_ticking(self):
+        self._next_tick = None
+
+    def reschedule(self):
+        """After a change of `interval`: the next tick is at most `interval` from now."""
+        deadline = time.monotonic() + self.interval
+        if self.is_ticking and deadline < self._next_tick:
+            self._schedule_tick(deadline)
+
+    def _schedule_tick(self, deadline: float):
+        self._next_tick = deadline
+        self.runtime.call_at(deadline, lambda: self._tick(deadline))
+
+    def _tick(self, deadline: float):
+        if not self._is_running or deadline != self._next_tick:
+            return  # Stopped (or rescheduled) since scheduled.
+        self.on_tick()
+        if self._next_tick == deadline:  # Not stopped by `on_tick`.
+            self._schedule_tick(deadline + self.interval)
+
+    def on_tick(self):
+        """Periodic output."""
+
+    def enable_verification(self, sequence: int = 0):
+        """Tags the data frames with sequence numbers (from `sequence + 1`) and checksums."""
+        if self.frame_format is None:
+            raise ValueError(f'{self.__class__.__name__} does not support verification.')
+        self.sequence = sequence
+
+    def tag(self, data_string: str) -> str:
+        """Tags a data frame (without terminator) in verification mode."""
+        if self.sequence is None:
+            return data_string
+        self.sequence += 1
+        return FRAME_FORMATS[self.frame_format].tag(data_string, self.sequence)
+
+    def stop_output(self):
+        """Stops the nominal (periodic) output. E.g. before a firehose run."""
+        self.stop_ticking()
+
+    def frames(self, n: int) -> List[bytes]:
+        """`n` successive frames, as written on the port. Used by the firehose."""
+        frames = []
+        for _ in range(n):
+            self.make_data_string()
+            frames.append((self.data_string + "\r\n").encode(self.binary_format))
+        return frames
+
+    def on_readable(self):
+        """Called by the runtime when bytes are waiting on the serial port."""
+        try:
+            data = self.serial.read(self.serial.in_waiting or 1)
+        except Exception as err:
+            self.log.debug(f'Error While reading error: {err}')
+            return
+        if data:
+            self.on_bytes(data)
+
+    def on_bytes(self, data: bytes):
+        pass
+
+    def send(self, msg: str, end_char=True):
+        if end_char:
+            msg += "\r\n"
+        self.write(msg.encode(self.binary_format))
+        self.log.info(rf'`{msg}` sent')
+
+    def write(self, data: bytes):
+        if self.fanout is not None:
+            self.fanout.publish(data)
+        else:
+            self.queue(data)
+
+    def queue(self, data: bytes):
+        """Queues `data` on the serial port. Thread safe, never blocks."""
+        if threading.current_thread() is self.runtime.thread:
+            self._queue(data)
+        else:
+            self.runtime.call_soon_threadsafe(lambda: self._queue(data))
+
+    def _queue(self, data: bytes):
+        queue = self.outbound if self._held is None else self._held
+        if not queue.put(data):
+            self.log.debug(f'Outbound queue full ({queue.policy}). Frame dropped.')
+        self.flush()
+
+    def stream(self, chunks: Iterator[bytes]):
+        """
+        Streams `chunks` on the serial port (not published to the fanout).
+        The next chunk is pulled once the outbound queue is drained, so the
+        stream is never queued whole nor dropped. Runtime thread only.
+        """
+        self._stream = iter(chunks)
+        self._stream_buffer = b""
+        if self._held is None:
+            self._held = OutboundQueue(self.outbound.max_bytes, self.outbound.policy)
+        self.flush()
+
+    def stop_stream(self):
+        """
+        Drops the chunks not yet pulled. The chunk already pulled is still
+        written whole (no partial frame). Runtime thread only.
+        """
+        if self._stream is not None and self._stream_buffer:
+            self._stream = iter(())
+        else:
+            self._end_stream()
+
+    def _end_stream(self):
+        self._stream = None
+        self._stream_buffer = b""
+        if self._held is not None:
+            held, self._held = self._held, None
+            self.outbound.absorb(held)
+
+    def _pull_stream(self) -> bool:
+        """Queues the next bytes of the stream. Returns False once it is exhausted."""
+        data = self._stream_buffer or next(self._stream, b"")
+        if not data:
+            self._end_stream()
+            return bool(self.outbound)  # Held frames to write.
+        # The queue was just drained: queue up to its size.
+        size = self.outbound.max_bytes
+        self._stream_buffer = data[size:] if self.outbound.offer(data[:size]) else data
+        return True
+
+    def flush(self):
+        if self._write_blocked:
+            return  # Flushed by on_writable.
+        while True:
+            if not self.outbound.flush(self._write_nonblocking):
+                self._write_blocked = True
+                self.runtime.watch_write(self)
+                return
+            if self._stream is None or not self._pull_stream():
+                return
+
+    def on_writable(self):
+        """Called by the runtime when the blocked serial port is writable again."""
+        if self.outbound.flush(self._write_nonblocking):
+            self._write_blocked = False
+            self.runtime.watch_write(self, False)
+            if self._stream is not None:
+                self.flush()
+
+    def _write_nonblocking(self, data: memoryview) -> int:
+        """
+        Notes
+        -----
+            pyserial busy loops in `write` on a full port when `write_timeout=0`,
+            so the (non-blocking) file descriptor is written directly.
+        """
+        try:
+            return os.write(self.fileno(), data)
+        except BlockingIOError:
+            return 0
+
+    def close(self):
+        self.log.info('Closing Serial')
+        self._is_running = False
+
+        if self.runtime is not None:
+            self.runtime.remove(self)
+            if self._shared_runtime:
+                self._shared_runtime = False
+                release_shared_runtime()
+
+        if self.fanout is not None:
+            self.fanout.close()
+        if self.outbound is not None:
+            self.log.info(f'Outbound: {self.outbound.stats()}')
+        if self.serial is not None:
+            self.serial.close()
+        self.log.info('Serial Closed')
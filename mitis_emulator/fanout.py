@@ -0,0 +1,236 @@
+"""
+Fan-out of a single device stream to many subscribers.
+
+A device publishes each frame once in a shared buffer. Every subscriber
+(serial port, tcp client, capture file) reads it from its own cursor, in its
+own thread, so a slow subscriber never delays the others.
+
+Each subscriber can lag at most `max_pending` frames behind the publisher.
+When a new frame would exceed that bound, its policy applies:
+    drop:       the oldest pending frames of that subscriber are skipped.
+    block:      the publisher waits for the subscriber (lossless, but couples
+                the device to that subscriber; meant for the primary port).
+    disconnect: the subscriber is closed.
+
+The shared buffer only keeps the frames not yet read by every subscriber,
+so its size is bounded by the largest `max_pending`.
+"""
+
+import socket
+import threading
+from collections import deque
+from typing import Callable, List
+
+from .logger import make_logger
+
+DROP = "drop"
+BLOCK = "block"
+DISCONNECT = "disconnect"
+POLICIES = (DROP, BLOCK, DISCONNECT)
+
+log = make_logger("FanOut")
+
+
+class Subscriber:
+    def __init__(self, fanout: "FanOut", name: str, write: Callable[[bytes], object], max_pending: int, policy: str,
+                 on_close: Callable[[], object] = None, interrupt: Callable[[], object] = None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown policy `{policy}`. Expected one of {POLICIES}.')
+
+        self.fanout = fanout
+        self.name = name
+        self.write = write
+        self.max_pending = max_pending
+        self.policy = policy
+        self.on_close = on_close
+        self.interrupt = interrupt
+
+        self.cursor = fanout.head
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self.run, name=f"fanout-{name}", daemon=True)
+
+    @property
+    def pending(self):
+        return self.fanout.head - self.cursor
+
+    def run(self):
+        while True:
+            frames = self.fanout.read(self)
+            if frames is None:
+                break
+            try:
+                self.write(b"".join(frames))
+                self.sent += len(frames)
+            except Exception as err:
+                if not self.closed:  # Else interrupted once closed.
+                    log.warning(f'Subscriber {self.name} disconnected: {err}')
+                    self.fanout.unsubscribe(self)
+                break
+
+        if self.on_close is not None:
+            self.on_close()
+
+    def close(self):
+        self.fanout.unsubscribe(self)
+
+    def _interrupt(self):
+        """Unblocks a `write` in progress (e.g. to a stalled tcp client) once closed."""
+        if self.interrupt is not None:
+            try:
+                self.interrupt()
+            except OSError:
+                pass
+
+
+class FanOut:
+    def __init__(self):
+        self._frames = deque()
+        self._tail = 0  # sequence number of self._frames[0]
+        self.head = 0  # sequence number of the next frame.
+        self._cond = threading.Condition()
+        self.subscribers: List[Subscriber] = []
+        self.sinks = []
+
+    def subscribe(self, name: str, write: Callable[[bytes], object], max_pending=256, policy=DROP,
+                  on_close: Callable[[], object] = None, interrupt: Callable[[], object] = None) -> Subscriber:
+        """
+        `on_close` is called from the subscriber thread once it stops.
+        `interrupt` is called when the subscriber is closed (by its policy or
+        `close`), to unblock its thread if it is blocked in `write`.
+        """
+        with self._cond:
+            subscriber = Subscriber(self, name, write, max_pending=max_pending, policy=policy, on_close=on_close,
+                                    interrupt=interrupt)
+            self.subscribers.append(subscriber)
+        subscriber.thread.start()
+        log.info(f'Subscribed: {name} (max pending: {max_pending}, policy: {policy})')
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._cond:
+            subscriber.closed = True
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            self._trim()
+            self._cond.notify_all()
+        subscriber._interrupt()
+
+    def publish(self, frame: bytes):
+        disconnected = []
+        with self._cond:
+            for subscriber in self.subscribers:
+                if subscriber.policy == BLOCK:
+                    while not subscriber.closed and subscriber.pending >= subscriber.max_pending:
+                        self._cond.wait()
+
+            self._frames.append(frame)
+            self.head += 1
+
+            for subscriber in list(self.subscribers):
+                overflow = subscriber.pending - subscriber.max_pending
+                if overflow <= 0:
+                    continue
+                if subscriber.policy == DROP:
+                    subscriber.cursor += overflow
+                    subscriber.dropped += overflow
+                elif subscriber.policy == DISCONNECT:
+                    log.warning(f'Subscriber {subscriber.name} too slow. Disconnecting.')
+                    subscriber.closed = True
+                    self.subscribers.remove(subscriber)
+                    disconnected.append(subscriber)
+
+            self._trim()
+            self._cond.notify_all()
+        for subscriber in disconnected:
+            subscriber._interrupt()
+
+    def read(self, subscriber: Subscriber):
+        """Blocks until frames are available. Returns all the pending frames or None once closed."""
+        with self._cond:
+            while not subscriber.closed and subscriber.cursor >= self.head:
+                self._cond.wait()
+            if subscriber.closed:
+                return None
+            start = subscriber.cursor - self._tail
+            frames = [self._frames[i] for i in range(start, start + subscriber.pending)]
+            subscriber.cursor = self.head
+            self._trim()
+            self._cond.notify_all()
+            return frames
+
+    def _trim(self):
+        """Drops the frames read by every subscriber."""
+        oldest = min((s.cursor for s in self.subscribers), default=self.head)
+        while self._tail < oldest:
+            self._frames.popleft()
+            self._tail += 1
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        for subscriber in list(self.subscribers):
+            subscriber.close()
+
+    def stats(self):
+        return {s.name: {'sent': s.sent, 'dropped': s.dropped, 'pending': s.pending} for s in self.subscribers}
+
+
+class FileSink:
+    """Capture file subscriber."""
+
+    def __init__(self, fanout: FanOut, path: str, max_pending=4096, policy=DROP):
+        self.file = open(path, 'ab')
+        fanout.sinks.append(self)
+        self.subscriber = fanout.subscribe(f'file:{path}', self.write, max_pending=max_pending, policy=policy,
+                                           on_close=self.file.close)
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        self.subscriber.close()
+
+
+class TcpSink:
+    """Tcp server. Every client connected is a subscriber of the stream."""
+
+    def __init__(self, fanout: FanOut, port: int, host="", max_pending=256, policy=DROP):
+        self.fanout = fanout
+        self.max_pending = max_pending
+        self.policy = policy
+
+        self.server = socket.create_server((host, port))
+        fanout.sinks.append(self)
+        self.thread = threading.Thread(target=self.run, name=f"fanout-tcp-{port}", daemon=True)
+        self.thread.start()
+        log.info(f'Tcp monitor listening on port {port}')
+
+    def run(self):
+        while True:
+            try:
+                conn, address = self.server.accept()
+            except OSError:
+                return
+            self.fanout.subscribe(f'tcp:{address[0]}:{address[1]}', conn.sendall,
+                                  max_pending=self.max_pending, policy=self.policy, on_close=conn.close,
+                                  interrupt=lambda c=conn: c.shutdown(socket.SHUT_RDWR))
+
+    def close(self):
+        self.server.close()
+
+
+def make_fanout(tcp_port: int = None, capture: str = None, max_pending=256, policy=DROP) -> FanOut:
+    """FanOut with the optional tcp monitor and capture file subscribers.
+
+    The device primary serial port is subscribed by the device on `start`.
+    """
+    fanout = FanOut()
+    if tcp_port is not None:
+        TcpSink(fanout, port=tcp_port, max_pending=max_pending, policy=policy)
+    if capture is not None:
+        FileSink(fanout, path=capture, max_pending=max_pending, policy=policy)
+    return fanout
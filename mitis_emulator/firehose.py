@@ -0,0 +1,249 @@
+"""
+Firehose stress mode: devices emit frames well above their nominal rate to
+find the limits of the link and of the acquisition software.
+
+The emission rate is ramped step by step (frames/s, or `max`: back-to-back
+frames at the link rate). At a given rate, frames are emitted by bursts
+following a pattern of burst sizes, cycled: e.g. (1,) is a steady stream,
+(10,) bursts of 10 frames every 10 / rate seconds, (1, 1, 20) two single
+frames then a burst of 20.
+
+The emulator is not the bottleneck:
+    - A pool of frames is formatted before the run (on the runtime thread,
+      once the nominal output is stopped) and cycled.
+    - At `max`, frames are pulled by the device stream only when its
+      outbound queue is drained, by batches filling the queue, so the link
+      is always busy and nothing is dropped. The frames written are counted
+      from the bytes written.
+    - Above the link rate, the outbound queue overflows and the dropped
+      frames are counted.
+
+At the end of every step, the emission stops and the frames already queued
+are written (for up to another step duration), then the frames (and bytes)
+offered, written to the port and dropped are recorded: the next step starts
+on an empty queue. Firehose frames are written to the serial
+port only, not published to the fanout. In verification mode, the frames
+are tagged on emission.
+"""
+
+import array
+import bisect
+import csv
+import itertools
+import threading
+import time
+from dataclasses import dataclass, asdict, fields
+from typing import Callable, Iterator, List, Optional, Sequence
+
+from .device import Device
+from .logger import make_logger
+from .verify import FRAME_FORMATS
+
+MAX = None  # step rate: back-to-back frames at the link rate.
+POOL_SIZE = 256  # frames formatted before the run.
+DRAIN_POLL = 0.005  # seconds
+
+
+@dataclass
+class StepResult:
+    device: str
+    port: str
+    step: int
+    rate: str  # frames/s, or "max".
+    burst: str
+    duration: float  # seconds
+    frames_offered: int
+    frames_written: int
+    frames_dropped: int
+    bytes_written: int
+    frames_per_s: float
+    bytes_per_s: float
+
+
+def parse_rates(rates: str) -> List[Optional[float]]:
+    """`10,100,max` -> [10., 100., MAX]. Raises ValueError on rates <= 0."""
+    parsed = [MAX if r.strip().lower() == "max" else float(r) for r in rates.split(",")]
+    if any(rate is not MAX and not rate > 0 for rate in parsed):
+        raise ValueError(f'Rates must be > 0 (or `max`): {rates}')
+    return parsed
+
+
+class Firehose:
+    def __init__(self, device: Device, rates: Sequence[Optional[float]], step_duration: float = 10.,
+                 bursts: Sequence[int] = (1,), pool_size: int = POOL_SIZE,
+                 on_done: Callable[["Firehose"], object] = None):
+        """
+        Parameters
+        ----------
+        device :
+            Started device. Its nominal output is stopped.
+        rates :
+            Frames/s of every step. MAX (None) for the link rate.
+        bursts :
+            Pattern of burst sizes (frames), cycled.
+        on_done :
+            Called (on the runtime thread) once every step is run.
+        """
+        if any(rate is not MAX and not rate > 0 for rate in rates):
+            raise ValueError(f'Rates must be > 0 (or MAX): {rates}')
+        if not bursts or any(n < 1 for n in bursts):
+            raise ValueError(f'Burst sizes must be >= 1: {bursts}')
+        self.device = device
+        self.rates = list(rates)
+        self.step_duration = step_duration
+        self.bursts = tuple(bursts)
+        self.pool_size = pool_size
+        self.on_done = on_done
+        self.log = make_logger("Firehose")
+
+        self.pool: List[bytes] = None  # Formatted by `_start`, on the runtime thread.
+        self.results: List[StepResult] = []
+        self.done = threading.Event()
+
+        self._frames: Iterator[bytes] = None
+        self._step = -1
+        self._step_start = 0.
+        self._offered = 0
+        self._stats = None
+        self._next_burst = None  # Deadline of the next burst. None between steps.
+        self._streamed = 0  # Bytes of the frames streamed during a `max` step.
+        self._frame_ends = array.array("q")  # Cumulative end (bytes) of every frame streamed during a `max` step.
+        self._queued_at_start = 0  # Bytes queued before a `max` step.
+
+    def start(self):
+        """Thread safe."""
+        self.device.runtime.call_soon_threadsafe(self._start)
+
+    def _start(self):
+        self.device.stop_output()
+        self.pool = self.device.frames(self.pool_size)
+        self._frames = itertools.cycle(self.pool)
+        self._next_step()
+
+    def _next_step(self):
+        self._step += 1
+        if self._step >= len(self.rates):
+            self.log.info(f'{self.device.__class__.__name__}: done.')
+            self.done.set()
+            if self.on_done is not None:
+                self.on_done(self)
+            return
+
+        rate = self.rates[self._step]
+        self._offered = 0
+        self._stats = self.device.outbound.stats()
+        self._step_start = time.monotonic()
+        self.device.runtime.call_at(self._step_start + self.step_duration, self._end_step)
+        self.log.info(f'{self.device.__class__.__name__}: step {self._step}, rate: {rate or "max"} frames/s')
+
+        if rate is MAX:
+            self._streamed = 0
+            self._frame_ends = array.array("q")
+            self._queued_at_start = self._stats["queued_bytes"]
+            self.device.stream(self._stream())
+        else:
+            self._next_burst = self._step_start
+            deadline = self._next_burst
+            self._burst(deadline, itertools.cycle(self.bursts), rate)
+
+    def _tag(self, frame: bytes) -> bytes:
+        """Pool frames are tagged on emission in verification mode."""
+        if self.device.sequence is None:
+            return frame
+        terminator = FRAME_FORMATS[self.device.frame_format].terminator
+        body = frame[:-len(terminator)].decode(self.device.binary_format)
+        return self.device.tag(body).encode(self.device.binary_format) + terminator
+
+    def _stream(self) -> Iterator[bytes]:
+        """
+        Frames pulled by the device as fast as the port is drained, by
+        batches of up to the outbound queue size. Frames are tagged (and
+        counted offered) when their batch is pulled.
+        """
+        max_bytes = self.device.outbound.max_bytes
+        batch, size = [], 0
+        for frame in self._frames:
+            if batch and size + len(frame) > max_bytes:
+                yield self._batch(batch)
+                batch, size = [], 0
+            batch.append(frame)
+            size += len(frame)
+
+    def _batch(self, frames: List[bytes]) -> bytes:
+        frames = [self._tag(frame) for frame in frames]
+        for frame in frames:
+            self._streamed += len(frame)
+            self._frame_ends.append(self._streamed)
+        self._offered += len(frames)
+        return b"".join(frames)
+
+    def _burst(self, deadline: float, bursts: Iterator[int], rate: float):
+        if deadline != self._next_burst:
+            return  # Step ended since scheduled.
+        n = next(bursts)
+        for frame in itertools.islice(self._frames, n):
+            self.device.queue(self._tag(frame))
+        self._offered += n
+
+        self._next_burst = deadline + n / rate
+        deadline = self._next_burst
+        self.device.runtime.call_at(deadline, lambda: self._burst(deadline, bursts, rate))
+
+    def _end_step(self):
+        self._next_burst = None
+        self.device.stop_stream()
+        self._drain(time.monotonic() + self.step_duration)
+
+    def _drain(self, deadline: float):
+        if self.device.outbound and time.monotonic() < deadline:
+            self.device.runtime.call_later(DRAIN_POLL, lambda: self._drain(deadline))
+            return
+        self._record()
+
+    def _record(self):
+        duration = time.monotonic() - self._step_start
+        stats = self.device.outbound.stats()
+        bytes_written = stats["bytes_written"] - self._stats["bytes_written"]
+        rate = self.rates[self._step]
+        if rate is MAX:
+            # Frames streamed by batches: complete frames within the streamed bytes written.
+            written = bisect.bisect_right(self._frame_ends, bytes_written - self._queued_at_start)
+        else:
+            written = stats["frames_written"] - self._stats["frames_written"]
+
+        result = StepResult(
+            device=self.device.__class__.__name__,
+            port=self.device.serial.port,
+            step=self._step,
+            rate="max" if rate is MAX else f"{rate:g}",
+            burst=",".join(map(str, self.bursts)),
+            duration=round(duration, 3),
+            frames_offered=self._offered,
+            frames_written=written,
+            frames_dropped=stats["frames_dropped"] - self._stats["frames_dropped"],
+            bytes_written=bytes_written,
+            frames_per_s=round(written / duration, 1),
+            bytes_per_s=round(bytes_written / duration, 1),
+        )
+        self.results.append(result)
+        self.log.info(f'{result}')
+        self._next_step()
+
+
+def write_report(path: str, results: List[StepResult]):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(StepResult)])
+        writer.writeheader()
+        writer.writerows(asdict(r) for r in results)
+
+
+def run_firehose(devices: List[Device], rates: Sequence[Optional[float]], step_duration: float = 10.,
+                 bursts: Sequence[int] = (1,)) -> List[StepResult]:
+    """Runs a firehose on every (started) device and waits for them."""
+    firehoses = [Firehose(device, rates, step_duration=step_duration, bursts=bursts) for device in devices]
+    for firehose in firehoses:
+        firehose.start()
+    for firehose in firehoses:
+        firehose.done.wait()
+
+    return [result for firehose in firehoses for result in firehose.results]
@@ -0,0 +1,210 @@
+"""
+Offline generation of deployment data files.
+
+The devices data-string builders are used headless (no serial port, no
+thread) to write PD8 (WorkHorse), SBE37 and NMEA (GPS) files.
+
+The time range of every instrument is split in parts generated in a process
+pool. Each part is written, optionally compressed, with large buffered
+writes, then the parts are concatenated in order. Concatenated gzip members
+and zstd frames are themselves valid gzip and zstd streams.
+
+Every instrument gets its own seed derived from the run `seed`: a run is
+reproducible bit for bit, whatever the part duration and number of workers.
+"""
+
+import datetime
+import gzip
+import logging
+import os
+import secrets
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from .adcp_workhorse import WorkHorse, pd8_ensembles
+from .cache import derive_seed
+from .gps import GPS
+from .sample_store import SAMPLE_DTYPE, format_samples
+from .sbe37 import SBE37, SAMPLES
+
+INSTRUMENTS = ("workhorse", "sbe37", "gps")
+EXTENSIONS = {"workhorse": ".pd8", "sbe37": ".txt", "gps": ".nmea"}
+COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+BATCH_SIZE = 3600  # samples formatted per write.
+BUFFER_SIZE = 8 * 1024 ** 2
+
+
+@dataclass(frozen=True)
+class Part:
+    instrument: str
+    path: str
+    start: datetime.datetime  # deployment start
+    first: int  # number of the first sample of the part, from the deployment start.
+    count: int
+    interval: float  # seconds
+    nbin: int
+    compression: str
+    level: int
+    seed: int = None
+
+
+def open_output(path: str, compression: str = "none", level: int = None):
+    """Binary, buffered, optionally compressed, output file."""
+    if compression == "none":
+        return open(path, "wb", buffering=BUFFER_SIZE)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=open(path, "wb", buffering=BUFFER_SIZE), mode="wb",
+                             compresslevel=1 if level is None else level)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd compression requires the `zstandard` package.")
+        raw = open(path, "wb", buffering=BUFFER_SIZE)
+        return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(raw, closefd=True)
+    raise ValueError(f'Unknown compression `{compression}`. Expected one of {tuple(COMPRESSIONS)}.')
+
+
+def _batches(part: Part) -> Iterator[np.ndarray]:
+    """Sample numbers of the part, by batches of BATCH_SIZE."""
+    for first in range(part.first, part.first + part.count, BATCH_SIZE):
+        yield np.arange(first, min(first + BATCH_SIZE, part.first + part.count))
+
+
+def _timestamps(part: Part, numbers: np.ndarray) -> List[datetime.datetime]:
+    return [part.start + datetime.timedelta(seconds=s) for s in (numbers * part.interval).tolist()]
+
+
+def _headless(device):
+    """Device used only for its data-string builder: logs warnings only."""
+    device.log.setLevel(logging.WARNING)
+    return device
+
+
+def workhorse_data(part: Part) -> Iterator[bytes]:
+    workhorse = _headless(WorkHorse(sampling_rate=part.interval, seed=part.seed))
+    for numbers in _batches(part):
+        block = workhorse.ensembles(int(numbers[0]), len(numbers), part.nbin)
+        ensembles = pd8_ensembles(_timestamps(part, numbers), (numbers + 1).tolist(), block)
+        yield b"\n\n".join(ensembles) + b"\n\n"
+
+
+def sbe37_data(part: Part) -> Iterator[bytes]:
+    """Samples with their date and time, as uploaded (`DD`)."""
+    sbe37 = _headless(SBE37())
+    start = part.start.replace(tzinfo=datetime.timezone.utc).timestamp()  # Written as given (gmtime).
+    for numbers in _batches(part):
+        samples = np.empty(len(numbers), dtype=SAMPLE_DTYPE)
+        samples["time"] = start + numbers * part.interval
+        for name, value in zip(("temperature", "conductivity", "salinity", "density"), SAMPLES[sbe37.low_salinity]):
+            samples[name] = value
+        yield format_samples(samples)
+
+
+def gps_data(part: Part) -> Iterator[bytes]:
+    gps = _headless(GPS())
+    lines = []
+    for numbers in _batches(part):
+        for timestamp in _timestamps(part, numbers):
+            gps.make_data_string(now=timestamp)
+            lines.append(gps.data_string)
+        yield ("\r\n".join(lines) + "\r\n").encode(gps.binary_format)
+        lines.clear()
+
+
+DATA = {"workhorse": workhorse_data, "sbe37": sbe37_data, "gps": gps_data}
+
+
+def write_part(part: Part) -> int:
+    """Writes a part file. Returns the number of uncompressed bytes."""
+    size = 0
+    with open_output(part.path, part.compression, part.level) as f:
+        for data in DATA[part.instrument](part):
+            f.write(data)
+            size += len(data)
+    return size
+
+
+def concatenate(paths: List[str], output: str):
+    """Concatenates the files in `output` and removes them."""
+    os.replace(paths[0], output)
+    with open(output, "ab") as out:
+        for path in paths[1:]:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, out, BUFFER_SIZE)
+            os.remove(path)
+
+
+def generate(
+        output_dir: str,
+        start: datetime.datetime,
+        duration: datetime.timedelta,
+        counts: Dict[str, int],
+        intervals: Dict[str, float],
+        nbin: int = 25,
+        compression: str = "none",
+        level: int = None,
+        workers: int = None,
+        part_duration: datetime.timedelta = datetime.timedelta(hours=24),
+        seed: int = None,
+) -> Dict[str, int]:
+    """
+    Parameters
+    ----------
+    counts :
+        Number of instruments of each type. E.g. {"workhorse": 2, "sbe37": 4}
+    intervals :
+        Sampling interval (seconds) of each type.
+    part_duration :
+        Time range generated by a single task of the process pool.
+    seed :
+        Seed of the run. Random by default.
+
+    Returns
+    -------
+        The uncompressed size of every output file, by path.
+    """
+    for instrument in INSTRUMENTS:
+        if counts.get(instrument, 0) and duration.total_seconds() < intervals[instrument]:
+            raise ValueError(f'{instrument}: duration ({duration}) shorter than the interval ({intervals[instrument]}s).')
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    seed = secrets.randbits(63) if seed is None else seed
+
+    parts: Dict[str, List[Part]] = {}
+    for instrument in INSTRUMENTS:
+        interval = intervals[instrument]
+        total = int(duration.total_seconds() // interval)
+        per_part = max(1, int(part_duration.total_seconds() // interval))
+        for index in range(counts.get(instrument, 0)):
+            instrument_seed = derive_seed(seed, instrument, index)
+            output = str(output_dir / f"{instrument}_{index + 1:02d}{EXTENSIONS[instrument]}{COMPRESSIONS[compression]}")
+            parts[output] = [
+                Part(instrument=instrument, path=f"{output}.part{i:04d}", start=start, first=first,
+                     count=min(per_part, total - first), interval=interval, nbin=nbin,
+                     compression=compression, level=level, seed=instrument_seed)
+                for i, first in enumerate(range(0, total, per_part))
+            ]
+
+    sizes = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {output: [executor.submit(write_part, part) for part in _parts]
+                       for output, _parts in parts.items()}
+            for output, _futures in futures.items():
+                sizes[output] = sum(future.result() for future in _futures)
+                concatenate([part.path for part in parts[output]], output)
+    except BaseException:
+        # Parts of the failed (and not yet concatenated) outputs.
+        for part in (part for _parts in parts.values() for part in _parts):
+            Path(part.path).unlink(missing_ok=True)
+        raise
+
+    return sizes
@@ -5,92 +5,60 @@ $GPRMC,193002,V,0000.0000,N,00000.0000,E,,,020109,005.1,W*74
 """
 
 
-import time
 import datetime
-import threading
-import serial
 
-from mitis_emulator.logger import make_logger
+from mitis_emulator.device import Device, check_interval
+from mitis_emulator.fanout import FanOut
+from mitis_emulator.outbound import OutboundQueue
+from mitis_emulator.verify import NMEAFormat
 
-import logging
 
+class GPS(Device):
+    __slots__ = ("longitude", "latitude", "clock_speed")
 
-class GPS:
     beaudrate = 19_200
     timeout = .1
     binary_format = 'ascii'
-    buffer_size = 1
-    clock_speed = .1
-    transmit_sleep = 0.01
+    reads = False
+    frame_format = "nmea"
+    settings = ("latitude", "longitude")
+    interval_setting = "clock_speed"
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, clock_speed: float = .1):
+        """
+        Parameters
+        ----------
+        clock_speed :
+            Seconds between fixes.
+        """
+        super().__init__(debug=debug)
         self.longitude = -60
         self.latitude = 50
-        log_level = logging.INFO
-        if debug is True:
-            log_level = logging.DEBUG
-
-        self.log = make_logger(self.__class__.__name__, level=log_level)
-
-        self.serial: serial.Serial = None
-        self.thread: threading.Thread = None
-
-        self._is_running = False
-
-        self.data_string = ""
-
-    @property
-    def is_running(self):
-        return self._is_running
-
-    def open_serial(self, port):
-        self.log.info(f'Opening port: {port}')
-
-        self.serial = serial.Serial()
-        self.serial.baudrate = self.beaudrate
-        self.serial.timeout = self.timeout
-        self.serial.port = port
+        self.clock_speed = check_interval(clock_speed)
 
-        try:
-            self.serial.open()
-        except serial.serialutil.SerialException as err:
-            self.log.error(f'Ports {err}  does not exist')
+    def on_start(self):
+        self.start_ticking()
 
-    def start(self, port):
-        self.open_serial(port)
-
-        if self.serial.is_open:
-            self._is_running = True
-            self.thread = threading.Thread(target=self.run, daemon=False)
-            self.thread.start()
-
-    def run(self):
-        self.log.info(f"Running ...")
-
-        while self._is_running:
-            time.sleep(self.clock_speed)
-            self.send_data()
-
-    def send(self, msg: str, end_char=True):
-        if end_char:
-            msg += "\r\n"
-        self.serial.write(msg.encode(self.binary_format))
-        self.log.info(rf'`{msg}` sent')
+    def on_tick(self):
+        self.send_data()
 
     def send_data(self):
         self.log.info('Sending Sample')
-        self.make_data_string(self)
-        self.send(self.data_string, end_char=True)
+        self.make_data_string()
+        self.send(self.tag(self.data_string), end_char=True)
 
-    def close(self):
-        self.log.info('Closing Serial')
-        self._is_running = False
-
-    def make_data_string(self):
+    def make_data_string(self, now: datetime.datetime = None):
         """
         $GPRMC,193002,V,0000.0000,N,00000.0000,E,,,020109,005.1,W*74
+
+        The checksum (`*hh`) is computed.
+
+        Parameters
+        ----------
+        now :
+            Fix time. Defaults to the current time.
         """
-        now = datetime.datetime.now()
+        now = now or datetime.datetime.now()
 
         _date = now.strftime("%d%m%y")
         _time = now.strftime("%H%M%S")
@@ -98,21 +66,24 @@ class GPS:
         _lon = str(abs(float(self.longitude))).split('.')
         _lat = str(abs(float(self.latitude))).split('.')
 
-        self.data_string = (f"$GPRMC,{_time},V,"
-                            f"{_lat[0]}{60*float('.'+_lat[1]):.2f},"
-                            f"{'N' if self.latitude >=0 else 'S'},"
-                            f"{_lon[0]}{60*float('.'+_lon[1]):.2f},"
-                            f"{'W' if self.longitude >=0 else 'E'}"
-                            f",0.000,180,{_date},005.1,W*74")
+        sentence = (f"GPRMC,{_time},V,"
+                    f"{_lat[0]}{60*float('.'+_lat[1]):.2f},"
+                    f"{'N' if self.latitude >=0 else 'S'},"
+                    f"{_lon[0]}{60*float('.'+_lon[1]):.2f},"
+                    f"{'W' if self.longitude >=0 else 'E'}"
+                    f",0.000,180,{_date},005.1,W")
+        self.data_string = f"${sentence}*{NMEAFormat.nmea_checksum(sentence.encode(self.binary_format)):02X}"
 
         self.log.info(f'NMEA: {self.data_string}')
 
 
-# def start_GPS(port: str, debug=False):
-#     gps = GPS(debug=debug)
-#     gps.start(port=port)
-#
-#     return gps
+def start_GPS(port: str, debug=False, fanout: FanOut = None, outbound: OutboundQueue = None, verify=False):
+    gps = GPS(debug=debug)
+    if verify:
+        gps.enable_verification()
+    gps.start(port=port, fanout=fanout, outbound=outbound)
+
+    return gps
 
 
 if __name__ == '__main__':
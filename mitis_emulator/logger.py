@@ -5,6 +5,9 @@ def make_logger(name: str, level=logging.DEBUG):
     logger = logging.getLogger(name)
     logger.setLevel(level)
 
+    if logger.handlers:  # Loggers are shared by name, e.g. by every instance of a device.
+        return logger
+
     handler = logging.StreamHandler()
     handler.setLevel(logging.DEBUG)
 
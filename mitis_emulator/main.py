@@ -46,14 +46,71 @@ def start():
     pass
 
 
+def fanout_options(func):
+    """Options to deliver a device stream to a tcp monitor and a capture file as well."""
+    from .fanout import POLICIES, DROP
+    func = click.option('--max_pending', type=click.INT, default=256, help='Frames a subscriber may lag.')(func)
+    func = click.option('--policy', type=click.Choice(POLICIES), default=DROP, help='Slow subscriber policy.')(func)
+    func = click.option('--capture', type=click.Path(dir_okay=False), default=None, help='Capture file.')(func)
+    func = click.option('--tcp', type=click.INT, default=None, help='Tcp monitor port.')(func)
+    return func
+
+
+def outbound_options(func):
+    """Bounded outbound queue of the serial port."""
+    from .outbound import OVERFLOW_POLICIES, DROP_NEWEST
+    func = click.option('--overflow', type=click.Choice(OVERFLOW_POLICIES), default=DROP_NEWEST,
+                        help='Outbound queue overflow policy.')(func)
+    func = click.option('--outbound_size', type=click.INT, default=64 * 1024, help='Outbound queue size (bytes).')(func)
+    return func
+
+
+def make_outbound(outbound_size, overflow):
+    from .outbound import OutboundQueue
+    return OutboundQueue(max_bytes=outbound_size, policy=overflow)
+
+
+def profile_options(func):
+    """Opt-in profiling of the device loops (dumped on SIGUSR1 and at exit)."""
+    func = click.option('--profile_interval', type=click.FLOAT, default=0.005, help='Sampling interval (s).')(func)
+    func = click.option('--profile_dir', type=click.Path(file_okay=False), default='.', help='Profile output directory.')(func)
+    func = click.option('--profile', type=click.Choice(['cprofile', 'sampling']), default=None, help='Profiler.')(func)
+    return func
+
+
+def enable_profiling(profile, profile_dir, profile_interval):
+    if profile is not None:
+        from .profiling import enable
+        enable(mode=profile, directory=profile_dir, interval=profile_interval)
+
+
+def open_fanout(tcp, capture, policy, max_pending):
+    if tcp is None and capture is None:
+        return None
+    from .fanout import make_fanout
+    return make_fanout(tcp_port=tcp, capture=capture, max_pending=max_pending, policy=policy)
+
+
 @start.command('sbe37')
 @click.argument('port', type=click.STRING)
 @click.option('-d', '--debug', is_flag=True)
 @click.option('-l', '--low_salinity', is_flag=True)
-def sbe37(port, debug, low_salinity):
+@click.option('--flash', type=click.Path(dir_okay=False), default=None,
+              help='Memory-mapped FLASH memory file (.npy), kept across restarts.')
+@click.option('--preload', type=click.INT, default=0, help='Number of samples stored before starting.')
+@click.option('--verify', is_flag=True, help='Tag the samples with sequence numbers and checksums.')
+@fanout_options
+@outbound_options
+@profile_options
+def sbe37(port, debug, low_salinity, flash, preload, verify, tcp, capture, policy, max_pending, outbound_size, overflow,
+          profile, profile_dir, profile_interval):
     from .sbe37 import start_SBE37
+    enable_profiling(profile, profile_dir, profile_interval)
     try:
-        s = start_SBE37(port=port, debug=debug)
+        s = start_SBE37(port=port, debug=debug, low_salinity=low_salinity,
+                        fanout=open_fanout(tcp, capture, policy, max_pending),
+                        outbound=make_outbound(outbound_size, overflow), flash=flash, preload=preload,
+                        verify=verify)
         if low_salinity:
             s.make_data_string(low_salinity=True)
     except serial.SerialException:
@@ -62,26 +119,279 @@ def sbe37(port, debug, low_salinity):
 
 @start.command('workhorse')
 @click.argument('port', type=click.STRING)
-@click.argument('sampling_rate', type=click.INT)
+@click.argument('sampling_rate', type=click.IntRange(min=1))
 @click.option('-d', '--debug', is_flag=True)
-def workhorse(port, sampling_rate, debug):
+@click.option('--recorder', type=click.Path(dir_okay=False), default=None,
+              help='Memory-mapped recorder file (.npy), kept across restarts.')
+@click.option('--recorder_capacity', type=click.INT, default=None,
+              help='Ensembles (default: recorder.RECORDER_CAPACITY). Oldest are overwritten.')
+@click.option('--verify', is_flag=True, help='Tag the ensembles with sequence numbers and checksums.')
+@click.option('--seed', type=click.INT, default=None, help='Seed of the synthetic data. Default: random.')
+@fanout_options
+@outbound_options
+@profile_options
+def workhorse(port, sampling_rate, debug, recorder, recorder_capacity, verify, seed, tcp, capture, policy, max_pending,
+              outbound_size, overflow, profile, profile_dir, profile_interval):
     from .adcp_workhorse import start_workhorse
+    enable_profiling(profile, profile_dir, profile_interval)
+    try:
+        start_workhorse(port=port, sampling_rate=sampling_rate, debug=debug,
+                        fanout=open_fanout(tcp, capture, policy, max_pending),
+                        outbound=make_outbound(outbound_size, overflow), recorder=recorder,
+                        recorder_capacity=recorder_capacity, verify=verify, seed=seed)
+    except serial.SerialException:
+        click.secho(f'Port `{port}` does not exist.', fg='red')
+
+
+@start.command('gps')
+@click.argument('port', type=click.STRING)
+@click.option('-d', '--debug', is_flag=True)
+@click.option('--verify', is_flag=True, help='Tag the fixes with sequence numbers.')
+@fanout_options
+@outbound_options
+@profile_options
+def gps(port, debug, verify, tcp, capture, policy, max_pending, outbound_size, overflow,
+        profile, profile_dir, profile_interval):
+    from .gps import start_GPS
+    enable_profiling(profile, profile_dir, profile_interval)
+    try:
+        start_GPS(port=port, debug=debug, fanout=open_fanout(tcp, capture, policy, max_pending),
+                  outbound=make_outbound(outbound_size, overflow), verify=verify)
+    except serial.SerialException:
+        click.secho(f'Port `{port}` does not exist.', fg='red')
+
+
+@start.command('protocol')
+@click.argument('protocol', type=click.STRING)
+@click.argument('port', type=click.STRING)
+@click.option('-d', '--debug', is_flag=True)
+@click.option('--set', 'variables', type=click.STRING, multiple=True, help='Variable override: name=value.')
+@fanout_options
+@outbound_options
+@profile_options
+def protocol(protocol, port, debug, variables, tcp, capture, policy, max_pending, outbound_size, overflow,
+             profile, profile_dir, profile_interval):
+    """PROTOCOL: definition file (json), or bundled definition name."""
+    import json
+    from .protocol import load_protocol, ProtocolError
+    enable_profiling(profile, profile_dir, profile_interval)
+    try:
+        device_class = load_protocol(protocol).device_class
+    except (ProtocolError, ValueError) as err:
+        click.secho(f'{err}', fg='red')
+        return
+
+    overrides = {}
+    for variable in variables:
+        name, value = variable.split('=', 1)
+        try:
+            overrides[name] = json.loads(value)
+        except ValueError:
+            overrides[name] = value
+
     try:
-        start_workhorse(port=port, sampling_rate=sampling_rate, debug=debug)
+        device = device_class(debug=debug, **overrides)
+        device.start(port=port, fanout=open_fanout(tcp, capture, policy, max_pending),
+                     outbound=make_outbound(outbound_size, overflow))
     except serial.SerialException:
         click.secho(f'Port `{port}` does not exist.', fg='red')
 
 
+@root.command('generate')
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--start', type=click.DateTime(), default=None, help='Deployment start. Default: today 00:00.')
+@click.option('--days', type=click.FLOAT, default=1.)
+@click.option('-w', '--workhorse', type=click.INT, default=1, help='Number of WorkHorse.')
+@click.option('-s', '--sbe37', type=click.INT, default=1, help='Number of SBE37.')
+@click.option('-g', '--gps', type=click.INT, default=1, help='Number of GPS.')
+@click.option('--workhorse_interval', type=click.FLOAT, default=60., help='Seconds.')
+@click.option('--sbe37_interval', type=click.FLOAT, default=60., help='Seconds.')
+@click.option('--gps_interval', type=click.FLOAT, default=1., help='Seconds.')
+@click.option('--nbin', type=click.INT, default=25)
+@click.option('-c', '--compression', type=click.Choice(['none', 'gzip', 'zstd']), default='none')
+@click.option('--level', type=click.INT, default=None, help='Compression level.')
+@click.option('-j', '--workers', type=click.INT, default=None, help='Default: number of cpu.')
+@click.option('--part_hours', type=click.FLOAT, default=24., help='Time range generated per task.')
+@click.option('--seed', type=click.INT, default=None, help='Same seed, same files. Default: random.')
+def generate(output_dir, start, days, workhorse, sbe37, gps, workhorse_interval, sbe37_interval, gps_interval,
+             nbin, compression, level, workers, part_hours, seed):
+    import secrets
+    import time
+    from datetime import datetime, timedelta
+    from .generate import generate as _generate
+
+    start = start or datetime.combine(datetime.now().date(), datetime.min.time())
+    seed = secrets.randbits(63) if seed is None else seed
+    click.echo(f'Seed: {seed}')
+    t0 = time.monotonic()
+    try:
+        sizes = _generate(
+            output_dir, start=start, duration=timedelta(days=days),
+            counts={'workhorse': workhorse, 'sbe37': sbe37, 'gps': gps},
+            intervals={'workhorse': workhorse_interval, 'sbe37': sbe37_interval, 'gps': gps_interval},
+            nbin=nbin, compression=compression, level=level, workers=workers,
+            part_duration=timedelta(hours=part_hours), seed=seed,
+        )
+    except (ImportError, ValueError) as err:
+        click.secho(str(err), fg='red')
+        return
+    elapsed = time.monotonic() - t0
+
+    for path, size in sizes.items():
+        click.echo(f'{path}: {size / 1024 ** 2:.1f} MiB')
+    total = sum(sizes.values()) / 1024 ** 2
+    click.secho(f'{total:.1f} MiB generated in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.1f} MiB/s)', fg='green')
+
+
+@root.group('bench')
+def bench():
+    pass
+
+
+@bench.command('memory')
+@click.option('--devices', type=click.STRING, default='sbe37,workhorse,gps', help='Comma separated.')
+@click.option('--counts', type=click.STRING, default='1,10,100,1000', help='Comma separated.')
+@click.option('--serial', 'with_serial', is_flag=True, help='Give every device a (closed) serial port object.')
+@click.option('--warm', is_flag=True, help='Make a first data string on every device.')
+def bench_memory(devices, counts, with_serial, warm):
+    from .bench import memory_bench
+    results = memory_bench(devices.split(','), [int(c) for c in counts.split(',')], with_serial=with_serial, warm=warm)
+
+    click.echo(f'{"device":>10} {"count":>7} {"rss/device":>12} {"traced/device":>14}')
+    for r in results:
+        click.echo(f'{r.device:>10} {r.count:>7} {r.rss_per_device:>11.0f}B {r.traced_per_device:>13.0f}B')
+
+
+def _rates(ctx, param, value):
+    from .firehose import parse_rates
+    try:
+        return parse_rates(value)
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+
+
+def _bursts(ctx, param, value):
+    try:
+        bursts = [int(b) for b in value.split(',')]
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+    if any(b < 1 for b in bursts):
+        raise click.BadParameter(f'Burst sizes must be >= 1: {value}')
+    return bursts
+
+
+@bench.command('firehose')
+@click.argument('device', type=click.STRING)
+@click.argument('ports', type=click.STRING, nargs=-1, required=True)
+@click.option('--rates', type=click.STRING, default='1,10,100,1000,max', callback=_rates,
+              help='Frames/s (> 0) of every step, comma separated. `max`: link rate.')
+@click.option('--step_duration', type=click.FLOAT, default=10., help='Seconds.')
+@click.option('--bursts', type=click.STRING, default='1', callback=_bursts,
+              help='Burst sizes pattern (frames), comma separated.')
+@click.option('--report', type=click.Path(dir_okay=False), default=None, help='CSV report.')
+@click.option('--verify', is_flag=True, help='Tag the frames with sequence numbers and checksums.')
+@outbound_options
+def bench_firehose(device, ports, rates, step_duration, bursts, report, verify, outbound_size, overflow):
+    """DEVICE: sbe37, workhorse, gps, or a protocol definition. One device per port, on a shared runtime."""
+    import logging
+    from .bench import DEVICES
+    from .firehose import run_firehose, write_report
+    from .runtime import Runtime
+
+    if device in DEVICES:
+        device_class = DEVICES[device]
+    else:
+        from .protocol import load_protocol
+        device_class = load_protocol(device).device_class
+    if verify and device_class.frame_format is None:
+        raise click.BadParameter(f'`{device}` frames cannot be verified.', param_hint="'--verify'")
+
+    logging.disable(logging.INFO)
+    runtime = Runtime('Firehose')
+    _devices = []
+    for port in ports:
+        d = device_class()
+        if verify:
+            d.enable_verification()
+        d.start(port=port, runtime=runtime, outbound=make_outbound(outbound_size, overflow))
+        if not d.is_running:
+            click.secho(f'Port `{port}` does not exist.', fg='red')
+            return
+        _devices.append(d)
+    runtime.start()
+
+    try:
+        results = run_firehose(_devices, rates, step_duration=step_duration, bursts=bursts)
+    finally:
+        for d in _devices:
+            d.close()
+        runtime.stop()
+
+    click.echo(f'{"device":>10} {"port":>12} {"rate":>8} {"offered":>9} {"written":>9} {"dropped":>9} '
+               f'{"frames/s":>10} {"bytes/s":>12}')
+    for r in results:
+        click.echo(f'{r.device:>10} {r.port[-12:]:>12} {r.rate:>8} {r.frames_offered:>9} {r.frames_written:>9} '
+                   f'{r.frames_dropped:>9} {r.frames_per_s:>10.1f} {r.bytes_per_s:>12.0f}')
+    if report is not None:
+        write_report(report, results)
+        click.secho(f'Report: {report}', fg='green')
+
+
+@root.command('verify')
+@click.argument('capture', type=click.File('rb'))
+@click.option('-f', '--format', 'frame_format', type=click.Choice(['pd8', 'sbe37', 'nmea']), required=True,
+              help='pd8: WorkHorse, sbe37: SBE37, nmea: GPS.')
+def verify(capture, frame_format):
+    """Checks a capture (`-`: stdin) of a device in verification mode."""
+    import sys
+    from .verify import verify_stream
+    report = verify_stream(capture, frame_format)
+    for key, value in report.as_dict().items():
+        click.echo(f'{key:>12}: {value}')
+    if not report.ok:
+        click.secho('Delivery errors found.', fg='red')
+        sys.exit(1)
+    click.secho('No delivery error.', fg='green')
+
+
+@root.group('cache')
+def cache():
+    pass
+
+
+@cache.command('info')
+@click.option('--directory', type=click.Path(file_okay=False), default=None)
+def cache_info(directory):
+    from .cache import DataCache, CACHE_DIRECTORY
+    data_cache = DataCache(directory or CACHE_DIRECTORY)
+    entries = data_cache.entries()
+    size = sum(size for _, size, _ in entries) / 1024 ** 2
+    click.echo(f'{data_cache.directory}: {len(entries)} entries, {size:.1f} MiB')
+
+
+@cache.command('clear')
+@click.option('--directory', type=click.Path(file_okay=False), default=None)
+def cache_clear(directory):
+    from .cache import DataCache, CACHE_DIRECTORY
+    data_cache = DataCache(directory or CACHE_DIRECTORY)
+    data_cache.clear()
+    click.secho(f'{data_cache.directory} cleared.', fg='green')
+
+
 @start.command('devices')
 @click.option('-d', '--debug', is_flag=True)
-def devices(debug):
+@click.option('-w', '--watch', is_flag=True, help='Apply the configuration file changes to the running devices.')
+@click.option('--watch_interval', type=click.FLOAT, default=1., help='Configuration polling interval (s).')
+@profile_options
+def devices(debug, watch, watch_interval, profile, profile_dir, profile_interval):
     from .server import start_devices
+    enable_profiling(profile, profile_dir, profile_interval)
     # try:
-    #     _ = start_devices(debug=debug)
+    #     _ = start_devices(debug=debug, watch=watch, watch_interval=watch_interval)
     # except serial.SerialException:
     #     click.secho(f'One of the ports does not exist.', fg='red')
 
-    _ = start_devices(debug=debug)
+    _ = start_devices(debug=debug, watch=watch, watch_interval=watch_interval)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,137 @@
+"""
+Bounded outbound queue of a device.
+
+Frames are queued and drained with non-blocking writes by the runtime when
+the port is writable, so a controller that stops reading only fills its own
+device queue and never blocks the runtime (and the other devices).
+
+When a frame does not fit in `max_bytes`, the overflow policy applies:
+    drop_newest: the new frame is dropped (default).
+    drop_oldest: queued frames are dropped until it fits. A partially
+                 written frame is never dropped.
+    reset:       every queued frame not yet started is dropped.
+"""
+
+import threading
+from collections import deque
+from typing import Callable
+
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+RESET = "reset"
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, RESET)
+
+
+class OutboundQueue:
+    __slots__ = ("max_bytes", "policy", "frames", "size", "offset", "lock",
+                 "frames_queued", "frames_written", "bytes_written", "frames_dropped", "bytes_dropped",
+                 "overflows", "max_size")
+
+    def __init__(self, max_bytes: int = 64 * 1024, policy: str = DROP_NEWEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy `{policy}`. Expected one of {OVERFLOW_POLICIES}.')
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+        self.frames = deque()
+        self.size = 0  # bytes queued, not yet written.
+        self.offset = 0  # bytes of frames[0] already written.
+        self.lock = threading.Lock()
+
+        self.frames_queued = 0
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.frames_dropped = 0
+        self.bytes_dropped = 0
+        self.overflows = 0
+        self.max_size = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _drop(self, index: int):
+        frame = self.frames[index]
+        del self.frames[index]
+        self.size -= len(frame)
+        self.frames_dropped += 1
+        self.bytes_dropped += len(frame)
+
+    def put(self, frame: bytes) -> bool:
+        """Queues a frame. Returns False if it was dropped."""
+        with self.lock:
+            if self.size + len(frame) > self.max_bytes:
+                self.overflows += 1
+                # Index of the first frame that can be dropped.
+                first = 1 if self.offset else 0
+                if self.policy == DROP_OLDEST:
+                    while len(self.frames) > first and self.size + len(frame) > self.max_bytes:
+                        self._drop(first)
+                elif self.policy == RESET:
+                    while len(self.frames) > first:
+                        self._drop(first)
+
+                if self.size + len(frame) > self.max_bytes:
+                    self.frames_dropped += 1
+                    self.bytes_dropped += len(frame)
+                    return False
+
+            self.frames.append(frame)
+            self.size += len(frame)
+            self.frames_queued += 1
+            self.max_size = max(self.max_size, self.size)
+            return True
+
+    def offer(self, frame: bytes) -> bool:
+        """Queues a frame if it fits, without overflow policy. A rejected frame is not a drop."""
+        with self.lock:
+            if self.size + len(frame) > self.max_bytes:
+                return False
+            self.frames.append(frame)
+            self.size += len(frame)
+            self.frames_queued += 1
+            self.max_size = max(self.max_size, self.size)
+            return True
+
+    def absorb(self, other: "OutboundQueue"):
+        """Queues the frames of `other` (emptied), and adds its drops to ours."""
+        with other.lock:
+            frames, other.frames, other.size = other.frames, deque(), 0
+            dropped, other.frames_dropped, other.bytes_dropped = (other.frames_dropped, other.bytes_dropped), 0, 0
+        for frame in frames:
+            self.put(frame)
+        with self.lock:
+            self.frames_dropped += dropped[0]
+            self.bytes_dropped += dropped[1]
+
+    def flush(self, write: Callable[[memoryview], int]) -> bool:
+        """
+        Writes queued frames with the non-blocking `write` until it accepts
+        no more bytes. Returns True once the queue is empty.
+        """
+        with self.lock:
+            while self.frames:
+                frame = self.frames[0]
+                n = write(memoryview(frame)[self.offset:])
+                if not n:
+                    return False
+                self.offset += n
+                self.size -= n
+                self.bytes_written += n
+                if self.offset < len(frame):
+                    return False
+                self.frames.popleft()
+                self.offset = 0
+                self.frames_written += 1
+            return True
+
+    def stats(self) -> dict:
+        return {
+            "queued_bytes": self.size,
+            "max_queued_bytes": self.max_size,
+            "frames_queued": self.frames_queued,
+            "frames_written": self.frames_written,
+            "bytes_written": self.bytes_written,
+            "frames_dropped": self.frames_dropped,
+            "bytes_dropped": self.bytes_dropped,
+            "overflows": self.overflows,
+        }
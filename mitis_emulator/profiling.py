@@ -0,0 +1,248 @@
+"""
+Opt-in profiling of the running devices.
+
+When enabled (`mitis start ... --profile cprofile|sampling`):
+    - The hot methods of the devices are wrapped in timing spans:
+          read   (Device.on_readable)
+          parse  (on_bytes, on_message)
+          format (make_data_string, reply)
+          encode (send)
+          write  (Device.write)
+    - Every runtime loop runs under cProfile, or is sampled by a background
+      thread every `interval` seconds (`sampling`). From Python 3.12 cProfile
+      is process wide (`sys.monitoring`): a single profiler covers every
+      runtime thread. A runtime that can not be profiled (e.g. another
+      profiling tool is active) is sampled instead.
+
+`dump()` (also on SIGUSR1 and at exit) writes:
+    <pid>-<n>.spans.collapsed    self time (us) per span stack
+    <pid>-<n>.samples.collapsed  sampled stacks (sampling)
+    <pid>-<n>.pstats             merged cProfile stats (cprofile)
+The collapsed files are the input format of flamegraph.pl / speedscope.
+
+When disabled, no method is wrapped and the runtime loop is the plain one:
+the overhead is nil.
+"""
+
+import atexit
+import cProfile
+import functools
+import itertools
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from .logger import make_logger
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+MODES = (CPROFILE, SAMPLING)
+PROCESS_WIDE_CPROFILE = sys.version_info >= (3, 12)
+
+# class name -> {method: span}
+SPANS = {
+    "Device": {"on_readable": "read", "send": "encode", "write": "write"},
+    "SBE37": {"on_bytes": "parse", "on_message": "parse", "make_data_string": "format", "send_data": "send_data"},
+    "WorkHorse": {"on_bytes": "parse", "on_message": "parse", "reply": "format", "send": "encode",
+                  "make_data_string": "format", "send_data": "send_data"},
+    "GPS": {"make_data_string": "format", "send_data": "send_data"},
+    "ProtocolDevice": {"on_bytes": "parse", "on_message": "parse", "reply": "format", "send_data": "send_data"},
+}
+
+PROFILER: "Profiler" = None
+
+log = make_logger("Profiler")
+
+
+class SpanRecorder:
+    """Self time of every span stack, per thread."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.times = Counter()  # stack: seconds
+
+    def enter(self, name: str):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = [[threading.current_thread().name, 0., 0.]]
+        stack.append([name, time.perf_counter(), 0.])
+
+    def exit(self):
+        stack = self.local.stack
+        names = tuple(frame[0] for frame in stack)
+        name, start, children = stack.pop()
+        total = time.perf_counter() - start
+        stack[-1][2] += total
+        with self.lock:
+            self.times[names] += total - children
+
+    def collapsed(self) -> str:
+        with self.lock:
+            return "".join(f"{';'.join(stack)} {int(t * 1e6)}\n" for stack, t in self.times.items())
+
+
+def _span(name: str, func, spans: SpanRecorder):
+    """`spans` is bound once: a wrapper still running when profiling is disabled keeps its recorder."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        spans.enter(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            spans.exit()
+    wrapper.__wrapped_span__ = func
+    return wrapper
+
+
+def _device_classes():
+    from .device import Device
+    from .sbe37 import SBE37
+    from .adcp_workhorse import WorkHorse
+    from .gps import GPS
+    from .protocol import ProtocolDevice
+    return {cls.__name__: cls for cls in (Device, SBE37, WorkHorse, GPS, ProtocolDevice)}
+
+
+class Profiler:
+    def __init__(self, mode: str = CPROFILE, directory: str = ".", interval: float = 0.005):
+        if mode not in MODES:
+            raise ValueError(f'Unknown profiler `{mode}`. Expected one of {MODES}.')
+        self.mode = mode
+        self.directory = Path(directory)
+        self.interval = interval
+
+        self.spans = SpanRecorder()
+        self.profiles = []  # cProfile.Profile of every runtime thread (a single one if PROCESS_WIDE_CPROFILE).
+        self.threads = set()  # idents of the sampled threads.
+        self.samples = Counter()
+        self._dumps = itertools.count()
+        self._sampler: threading.Thread = None
+        self._lock = threading.Lock()
+        self._cprofile_users = 0  # runtime threads using the process wide profiler.
+
+    def run(self, func):
+        """Runs a runtime loop under the profiler."""
+        if self.mode == CPROFILE:
+            profile = self._enable_cprofile()
+            if profile is not None:
+                try:
+                    return func()
+                finally:
+                    self._disable_cprofile(profile)
+
+        self.start_sampler()
+        self.threads.add(threading.get_ident())
+        try:
+            return func()
+        finally:
+            self.threads.discard(threading.get_ident())
+
+    def _enable_cprofile(self) -> cProfile.Profile:
+        """Profiler of the calling thread. None if cProfile can not be enabled."""
+        with self._lock:
+            if PROCESS_WIDE_CPROFILE and self._cprofile_users:
+                self._cprofile_users += 1
+                return self.profiles[-1]
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as err:  # e.g. `Another profiling tool is already active`.
+                log.warning(f'cProfile unavailable ({err}), {threading.current_thread().name} is sampled instead.')
+                return None
+            self.profiles.append(profile)
+            self._cprofile_users += 1
+            return profile
+
+    def _disable_cprofile(self, profile: cProfile.Profile):
+        with self._lock:
+            self._cprofile_users -= 1
+            if not PROCESS_WIDE_CPROFILE or not self._cprofile_users:
+                profile.disable()
+
+    def start_sampler(self):
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self.sample, name="profiler", daemon=True)
+                self._sampler.start()
+
+    def sample(self):
+        while PROFILER is self:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident in list(self.threads):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def instrument(self):
+        classes = _device_classes()
+        for class_name, methods in SPANS.items():
+            cls = classes[class_name]
+            for method, span in methods.items():
+                if method in cls.__dict__:
+                    setattr(cls, method, _span(f"{span}:{class_name}.{method}", cls.__dict__[method], self.spans))
+
+    def uninstrument(self):
+        for cls in _device_classes().values():
+            for method, func in list(cls.__dict__.items()):
+                if hasattr(func, "__wrapped_span__"):
+                    setattr(cls, method, func.__wrapped_span__)
+
+    def pstats(self) -> pstats.Stats:
+        stats = pstats.Stats()
+        for profile in self.profiles:
+            profile.snapshot_stats()  # Unlike create_stats, does not stop the profiler.
+            snapshot = pstats.Stats()
+            snapshot.stats = dict(profile.stats)
+            snapshot.get_top_level_stats()
+            stats.add(snapshot)
+        return stats
+
+    def dump(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        prefix = str(self.directory / f"{os.getpid()}-{next(self._dumps)}")
+
+        paths = [Path(prefix + ".spans.collapsed")]
+        paths[0].write_text(self.spans.collapsed())
+        if self._sampler is not None:
+            paths.append(Path(prefix + ".samples.collapsed"))
+            paths[-1].write_text("".join(f"{stack} {n}\n" for stack, n in self.samples.items()))
+        if self.mode == CPROFILE and self.profiles:
+            paths.append(Path(prefix + ".pstats"))
+            self.pstats().dump_stats(paths[-1])
+
+        log.info(f'Profile written: {", ".join(map(str, paths))}')
+        return paths
+
+
+def enable(mode: str = CPROFILE, directory: str = ".", interval: float = 0.005, dump_signal=signal.SIGUSR1):
+    """Enables profiling of the runtimes started afterward. Call from the main thread."""
+    global PROFILER
+    PROFILER = Profiler(mode=mode, directory=directory, interval=interval)
+    PROFILER.instrument()
+    if mode == SAMPLING:
+        PROFILER.start_sampler()
+
+    signal.signal(dump_signal, lambda signum, frame: PROFILER and PROFILER.dump())
+    atexit.register(PROFILER.dump)
+    log.info(f'Profiling enabled ({mode}). `kill -{dump_signal.name[3:]} {os.getpid()}` to dump.')
+    return PROFILER
+
+
+def disable():
+    global PROFILER
+    if PROFILER is not None:
+        PROFILER.uninstrument()
+        atexit.unregister(PROFILER.dump)
+        PROFILER = None
@@ -0,0 +1,346 @@
+"""
+Declarative instrument protocols.
+
+An instrument is described by a JSON definition, compiled once at load time
+into a `ProtocolDevice` subclass running on the shared runtime:
+
+```
+{
+  "name": "SBE37",
+  "baudrate": 19200,
+  "encoding": "ascii",
+  "terminator": "\\r",          received commands terminator.
+  "line_end": "\\r\\n",          appended to every response line.
+  "prompt": "S>",              sent after every reply.
+  "echo": true,                commands are echoed.
+  "case_sensitive": false,
+  "reply_delay": 0.01,         seconds.
+  "unknown": null,             response to unknown commands. Ignored if null.
+  "variables": {"temperature": 23.7658, "interval": 60},
+  "templates": {"sample": "{temperature:9.4f}"},
+  "commands": {
+    "": {"echo": false},                         prompt only.
+    "ts": {"response": "{sample}"},
+    "sampleinterval=*": {"set": {"interval": "float"}},
+    "start": {"action": "start"},
+    "stop": {"action": "stop"}
+  },
+  "periodic": {"interval": "interval", "response": "{sample}", "running": false}
+}
+```
+
+Commands:
+    Keys ending with `*` take an argument (the rest of the command), available
+    as `{args}` in the templates. `set` casts it (`float`, `int`, `str`) to a
+    variable. `action` starts or stops the periodic output. `response` is a
+    template, or a list of templates (lines). `echo` and `prompt` override
+    the protocol ones.
+
+Templates:
+    `str.format` fields on the variables, the named `templates`, `{args}`,
+    `{now}` (datetime) and `{checksum}`: the NMEA checksum (2 hex digits) of
+    the line, between `$` and `*`. Other fields are rejected when the
+    definition is compiled. Responses without fields are encoded once.
+
+Periodic:
+    `response` sent every `interval` seconds (a number or a variable name)
+    while running. The interval must be > 0: in the definition, and when set
+    by a command (an invalid value is ignored).
+
+Received bytes are split on the terminator, then commands are matched with a
+dict (exact commands) and a character trie (commands with arguments).
+"""
+
+import datetime
+import json
+import re
+import string
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from .device import Device, check_interval
+from .verify import NMEAFormat
+
+PROTOCOLS_DIRECTORY = Path(__file__).resolve().parent.joinpath("protocols")
+ARGUMENT = "*"
+CASTS = {"float": float, "int": int, "str": str}
+ACTIONS = ("start", "stop")
+CHECKSUM = "checksum"
+RESERVED_FIELDS = ("args", "now", CHECKSUM)  # Template fields that are not variables.
+_CHECKSUM_MARK = "\0"
+_NMEA_SENTENCE = re.compile(r"\$([^$*\r\n]*)\*" + _CHECKSUM_MARK)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Template:
+    """Compiled response. Constant responses are encoded once."""
+    __slots__ = ("fmt", "fields", "constant", "encoding")
+
+    def __init__(self, fmt: str, encoding: str):
+        self.fmt = fmt
+        self.encoding = encoding
+        self.fields = {name.split(".")[0].split("[")[0]
+                       for _, name, _, _ in string.Formatter().parse(fmt) if name is not None}
+        if "" in self.fields:
+            raise ProtocolError(f'Positional field in template `{fmt}`. Fields must be named.')
+        self.constant = None if self.fields else fmt.encode(encoding)
+
+    def render(self, variables: dict, args: str = "") -> bytes:
+        if self.constant is not None:
+            return self.constant
+        context = dict(variables, args=args)
+        if "now" in self.fields:
+            context["now"] = datetime.datetime.now()
+        if CHECKSUM not in self.fields:
+            return self.fmt.format_map(context).encode(self.encoding)
+        context[CHECKSUM] = _CHECKSUM_MARK
+        text = _NMEA_SENTENCE.sub(
+            lambda m: f"${m.group(1)}*{NMEAFormat.nmea_checksum(m.group(1).encode(self.encoding)):02X}",
+            self.fmt.format_map(context))
+        return text.encode(self.encoding)
+
+
+class Command:
+    __slots__ = ("name", "response", "set", "action", "echo", "prompt")
+
+    def __init__(self, name: str, response: Optional[Template], set: Dict[str, type], action: Optional[str],
+                 echo: bool, prompt: bool):
+        self.name = name
+        self.response = response
+        self.set = set
+        self.action = action
+        self.echo = echo
+        self.prompt = prompt
+
+
+class Protocol:
+    """Compiled protocol definition."""
+
+    def __init__(self, definition: dict):
+        self.definition = definition
+        self.name = definition.get("name", "Protocol")
+        self.baudrate = definition.get("baudrate", 19_200)
+        self.encoding = definition.get("encoding", "ascii")
+        self.terminator = definition.get("terminator", "\r").encode(self.encoding)
+        self.line_end = definition.get("line_end", "\r\n")
+        self.prompt = definition.get("prompt", "").encode(self.encoding)
+        self.echo = definition.get("echo", True)
+        self.case_sensitive = definition.get("case_sensitive", False)
+        self.reply_delay = definition.get("reply_delay", 0.)
+        self.variables = dict(definition.get("variables", {}))
+        self.templates = definition.get("templates", {})
+
+        unknown = definition.get("unknown")
+        self.unknown = None if unknown is None else self._command("", {"response": unknown})
+
+        self.commands: Dict[str, Command] = {}
+        self.trie = {}  # char: node. The command of a node is at key None.
+        for key, spec in definition.get("commands", {}).items():
+            key = key if self.case_sensitive else key.lower()
+            if key.endswith(ARGUMENT):
+                node = self.trie
+                for char in key[:-len(ARGUMENT)]:
+                    node = node.setdefault(char, {})
+                node[None] = self._command(key, spec)
+            else:
+                self.commands[key] = self._command(key, spec)
+
+        periodic = definition.get("periodic")
+        self.periodic: Optional[Template] = None
+        self.periodic_interval: Union[float, str] = None
+        self.periodic_running = False
+        if periodic is not None:
+            self.periodic = self._template(periodic["response"], end=True)
+            self.periodic_interval = periodic.get("interval", 1.)
+            self.periodic_running = periodic.get("running", True)
+            if isinstance(self.periodic_interval, str) and self.periodic_interval not in self.variables:
+                raise ProtocolError(f'{self.name}: unknown periodic interval variable `{self.periodic_interval}`.')
+            interval = self.periodic_interval
+            try:
+                check_interval(self.variables[interval] if isinstance(interval, str) else interval)
+            except (TypeError, ValueError) as err:
+                raise ProtocolError(f'{self.name}: periodic interval: {err}')
+
+        self._device_class = None
+
+    @classmethod
+    def from_file(cls, path: str) -> "Protocol":
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def _template(self, response: Union[str, List[str]], end: bool = False) -> Template:
+        lines = [response] if isinstance(response, str) else list(response)
+        fmt = self.line_end.join(lines) + (self.line_end if end and lines else "")
+        for name, template in self.templates.items():
+            fmt = fmt.replace("{" + name + "}", template)
+        template = Template(fmt, self.encoding)
+        unknown = template.fields - set(self.variables) - set(RESERVED_FIELDS)
+        if unknown:
+            raise ProtocolError(f'{self.name}: unknown fields {sorted(unknown)} in `{fmt.strip()}`. '
+                                f'Expected variables {sorted(self.variables)}, templates {sorted(self.templates)} '
+                                f'or {RESERVED_FIELDS}.')
+        return template
+
+    def _command(self, name: str, spec: dict) -> Command:
+        unknown_casts = set(spec.get("set", {}).values()) - set(CASTS)
+        if unknown_casts:
+            raise ProtocolError(f'{self.name}: `{name}` unknown types {unknown_casts}. Expected one of {tuple(CASTS)}.')
+        if spec.get("action") not in (None,) + ACTIONS:
+            raise ProtocolError(f'{self.name}: `{name}` unknown action `{spec["action"]}`. Expected one of {ACTIONS}.')
+        return Command(
+            name=name,
+            response=self._template(spec["response"], end=True) if "response" in spec else None,
+            set={variable: CASTS[cast] for variable, cast in spec.get("set", {}).items()},
+            action=spec.get("action"),
+            echo=spec.get("echo", self.echo),
+            prompt=spec.get("prompt", True),
+        )
+
+    def match(self, msg: str) -> Tuple[Optional[Command], str]:
+        """Returns the command matching `msg` and its argument. The longest argument command prefix wins."""
+        key = msg if self.case_sensitive else msg.lower()
+        command = self.commands.get(key)
+        if command is not None:
+            return command, ""
+
+        node, match, end = self.trie, None, 0
+        for i, char in enumerate(key):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                match, end = node[None], i + 1
+        return match, msg[end:]
+
+    @property
+    def device_class(self) -> type:
+        """`ProtocolDevice` subclass sharing the compiled tables."""
+        if self._device_class is None:
+            self._device_class = type(self.name, (ProtocolDevice,), {
+                "__slots__": (),
+                "protocol": self,
+                "beaudrate": self.baudrate,
+                "binary_format": self.encoding,
+                "reads": True,
+                "settings": tuple(self.variables),
+            })
+        return self._device_class
+
+
+class ProtocolDevice(Device):
+    __slots__ = ("variables", "receive_buffer")
+
+    protocol: Protocol = None
+    interval_setting = "periodic_interval"
+
+    def __init__(self, debug=False, **variables):
+        """
+        Parameters
+        ----------
+        variables :
+            Overrides the protocol variables.
+        """
+        super().__init__(debug=debug)
+        self.variables = dict(self.protocol.variables, **variables)
+        self.receive_buffer = b""
+
+    @property
+    def periodic_interval(self) -> float:
+        interval = self.protocol.periodic_interval
+        return float(self.variables[interval] if isinstance(interval, str) else interval)
+
+    def on_start(self):
+        if self.protocol.periodic is not None and self.protocol.periodic_running:
+            self.start_periodic()
+
+    def start_periodic(self):
+        if self.protocol.periodic is None or self.is_ticking:
+            return
+        self.start_ticking()
+
+    def stop_periodic(self):
+        self.stop_ticking()
+
+    @classmethod
+    def check_settings(cls, variables: dict) -> dict:
+        unknown = set(variables) - set(cls.settings)
+        if unknown:
+            raise ValueError(f'{cls.protocol.name}: unknown variables {unknown}.')
+        interval = cls.protocol.periodic_interval
+        return {k: check_interval(v) if k == interval else v for k, v in variables.items()}
+
+    def configure(self, **variables):
+        self.variables.update(self.check_settings(variables))
+        if self.protocol.periodic_interval in variables:
+            self.reschedule()
+
+    def frames(self, n: int) -> List[bytes]:
+        if self.protocol.periodic is None:
+            raise ProtocolError(f'{self.protocol.name}: no periodic output.')
+        return [self.protocol.periodic.render(self.variables) for _ in range(n)]
+
+    def on_tick(self):
+        self.send_data()
+
+    def send_data(self):
+        self.write(self.protocol.periodic.render(self.variables))
+
+    def on_bytes(self, data: bytes):
+        *messages, self.receive_buffer = (self.receive_buffer + data).split(self.protocol.terminator)
+        for msg in messages:
+            self.on_message(msg.decode(self.binary_format, errors="replace"))
+
+    def on_message(self, msg: str):
+        self.log.info(f'Message received: {msg}')
+        command, args = self.protocol.match(msg)
+        if command is None:
+            command = self.protocol.unknown
+            if command is None:
+                self.log.warning(f"Received Unexpected {msg}")
+                return
+
+        try:
+            for variable, cast in command.set.items():
+                value = cast(args.strip())
+                if variable == self.protocol.periodic_interval:
+                    value = check_interval(value)
+                self.variables[variable] = value
+        except ValueError:
+            self.log.warning(f'Invalid argument `{args}` for `{command.name}`')
+        if self.protocol.periodic_interval in command.set:
+            self.reschedule()
+
+        if command.action == "start":
+            self.start_periodic()
+        elif command.action == "stop":
+            self.stop_periodic()
+
+        reply = self.reply(command, msg, args)
+        if self.protocol.reply_delay:
+            self.runtime.call_later(self.protocol.reply_delay, lambda: self.write(reply))
+        else:
+            self.write(reply)
+
+    def reply(self, command: Command, msg: str, args: str = "") -> bytes:
+        reply = b""
+        if command.echo:
+            reply += (msg + self.protocol.line_end).encode(self.binary_format)
+        if command.response is not None:
+            reply += command.response.render(self.variables, args)
+        if command.prompt:
+            reply += self.protocol.prompt
+        return reply
+
+
+def load_protocol(name: str) -> Protocol:
+    """Protocol from a definition file, or bundled (`protocols/<name>.json`)."""
+    path = Path(name)
+    if not path.is_file():
+        path = PROTOCOLS_DIRECTORY.joinpath(f"{name}.json")
+        if not path.is_file():
+            bundled = sorted(p.stem for p in PROTOCOLS_DIRECTORY.glob("*.json"))
+            raise ProtocolError(f'No protocol definition `{name}`. Bundled: {bundled}.')
+    return Protocol.from_file(str(path))
@@ -0,0 +1,117 @@
+"""
+Fixed capacity ring buffer of the ensembles recorded by a WorkHorse.
+
+Ensembles are packed binary records (time, number, heading, pitch, roll and
+the int16 velocities of every bin), so `capacity` bounds the memory used.
+Once full, the oldest ensembles are overwritten. In memory, the buffer is
+allocated on the first record and doubled as needed up to `capacity`, so an
+idle or young WorkHorse costs little. It is a memory-mapped `.npy` file of
+`capacity` records for long deployments (reloaded across restarts).
+
+`last()` is O(1) (`CE`), `chunks()` yields the records oldest first, by
+blocks, for streamed downloads.
+"""
+
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from .attitude import EnsembleBlock
+
+RECORDER_CAPACITY = 4096  # ensembles.
+INITIAL_RECORDS = 16  # in memory buffer allocated on the first record.
+DOWNLOAD_BLOCK = 64  # ensembles formatted per download chunk.
+
+
+def record_dtype(nbin: int) -> np.dtype:
+    return np.dtype([
+        ("time", "<f8"),  # epoch seconds
+        ("number", "<u4"),
+        ("heading", "<f4"),
+        ("pitch", "<f4"),
+        ("roll", "<f4"),
+        ("velocity", "<i2", (nbin, 4)),
+    ])
+
+
+class EnsembleRecorder:
+    __slots__ = ("capacity", "nbin", "path", "dtype", "_data", "head", "count")
+
+    def __init__(self, nbin: int, capacity: int = RECORDER_CAPACITY, path: str = None):
+        """
+        Parameters
+        ----------
+        path :
+            Memory-mapped `.npy` file. Existing ensembles (of `nbin` bins) are
+            reloaded.
+        """
+        self.nbin = nbin
+        self.capacity = capacity
+        self.path = path
+        self.dtype = record_dtype(nbin)
+        self._data: np.ndarray = None
+        self.head = 0  # index of the next record.
+        self.count = 0
+
+        if path is not None:
+            if Path(path).is_file():
+                self._data = np.load(path, mmap_mode="r+")
+                if self._data.dtype != self.dtype:
+                    raise ValueError(f'{path}: recorded ensembles do not have {nbin} bins.')
+                self.capacity = len(self._data)
+                self.count = int(np.count_nonzero(self._data["time"]))
+                self.head = (int(np.argmax(self._data["time"])) + 1) % self.capacity if self.count else 0
+            else:
+                self._data = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(capacity,))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes used by the recorded ensembles."""
+        return self.count * self.dtype.itemsize
+
+    def append(self, timestamp: float, number: int, block: EnsembleBlock):
+        """Records the first ensemble of `block`, overwriting the oldest when full."""
+        if self._data is None:
+            self._data = np.zeros(min(INITIAL_RECORDS, self.capacity), dtype=self.dtype)
+        elif self.head == len(self._data):
+            # Full below capacity (never wrapped yet: records are in order).
+            grown = np.zeros(min(2 * len(self._data), self.capacity), dtype=self.dtype)
+            grown[:len(self._data)] = self._data
+            self._data = grown
+
+        self._data[self.head] = (timestamp, number, block.heading[0], block.pitch[0], block.roll[0], block.velocity[0])
+
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def last(self) -> np.ndarray:
+        """Last recorded ensemble, as a 1 record array. None if empty."""
+        if not self.count:
+            return None
+        index = (self.head - 1) % self.capacity
+        return self._data[index:index + 1]
+
+    def chunks(self, block: int = DOWNLOAD_BLOCK) -> Iterator[np.ndarray]:
+        """Recorded ensembles, oldest first, by blocks of `block` records."""
+        first = (self.head - self.count) % self.capacity
+        for start in range(0, self.count, block):
+            indices = (first + np.arange(start, min(start + block, self.count))) % self.capacity
+            yield self._data[indices]
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        if self.path is not None:
+            self._data["time"] = 0
+
+    def flush(self):
+        if isinstance(self._data, np.memmap):
+            self._data.flush()
+
+
+def records_block(records: np.ndarray) -> EnsembleBlock:
+    return EnsembleBlock(records["heading"], records["pitch"], records["roll"], records["velocity"])
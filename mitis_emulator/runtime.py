@@ -0,0 +1,200 @@
+"""
+Single thread runtime shared by many devices.
+
+Devices do not own a thread. The runtime waits on every device serial port
+with a selector and calls `device.on_readable()` when bytes are available,
+`device.on_writable()` when a device waiting on a full port can write again
+(`watch_write`), and runs the timers (`call_at`, `call_later`) the devices
+schedule.
+
+Notes
+-----
+    Selectors on serial ports require a posix platform.
+"""
+
+import heapq
+import itertools
+import os
+import selectors
+import threading
+import time
+from typing import Callable
+
+from . import profiling
+from .logger import make_logger
+
+
+class Runtime:
+    __slots__ = ("name", "log", "selector", "timers", "devices", "_counter", "_lock", "_pending",
+                 "_wake_r", "_wake_w", "_is_running", "thread")
+
+    def __init__(self, name: str = "Runtime"):
+        self.name = name
+        self.log = make_logger(name)
+        self.selector = selectors.DefaultSelector()
+        self.timers = []  # heap of (deadline, counter, callback)
+        self.devices = {}  # device: (file descriptor, selector events)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._pending = []  # callbacks from other threads.
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._is_running = False
+        self.thread: threading.Thread = None
+
+    @property
+    def is_running(self):
+        return self._is_running
+
+    def call_at(self, deadline: float, callback: Callable[[], object]):
+        """Runs `callback` at `deadline` (time.monotonic). Runtime thread only."""
+        heapq.heappush(self.timers, (deadline, next(self._counter), callback))
+
+    def call_later(self, delay: float, callback: Callable[[], object]):
+        self.call_at(time.monotonic() + delay, callback)
+
+    def call_soon_threadsafe(self, callback: Callable[[], object]):
+        with self._lock:
+            self._pending.append(callback)
+        os.write(self._wake_w, b"\0")
+
+    def add(self, device):
+        """Adds a device with an open serial port. Thread safe."""
+        self.call_soon_threadsafe(lambda: self._add(device))
+
+    def remove(self, device, timeout: float = 1):
+        """Removes a device. Thread safe: waits (up to `timeout`) for the runtime to remove it."""
+        if threading.current_thread() is self.thread or not self._is_running:
+            self._remove(device)
+            return
+        removed = threading.Event()
+        self.call_soon_threadsafe(lambda: (self._remove(device), removed.set()))
+        removed.wait(timeout)
+
+    def _add(self, device):
+        self.devices[device] = (device.fileno(), 0)
+        self._set_events(device, selectors.EVENT_READ if device.reads else 0)
+        device.on_start()
+
+    def _remove(self, device):
+        if device not in self.devices:
+            return
+        self._set_events(device, 0)
+        self.devices.pop(device)
+
+    def _set_events(self, device, events: int):
+        fd, current = self.devices[device]
+        if events == current:
+            return
+        if not current:
+            self.selector.register(fd, events, device)
+        elif not events:
+            self.selector.unregister(fd)
+        else:
+            self.selector.modify(fd, events, device)
+        self.devices[device] = (fd, events)
+
+    def watch_write(self, device, watch=True):
+        """Calls `device.on_writable()` when its port is writable, until unwatched. Runtime thread only."""
+        if device not in self.devices:
+            return
+        events = self.devices[device][1]
+        if watch:
+            events |= selectors.EVENT_WRITE
+        else:
+            events &= ~selectors.EVENT_WRITE
+        self._set_events(device, events)
+
+    def _run_pending(self):
+        try:
+            os.read(self._wake_r, 4096)
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for callback in pending:
+            try:
+                callback()
+            except Exception as err:
+                self.log.error(f'{callback}: {err}')
+
+    def run(self):
+        self._is_running = True
+        self.thread = threading.current_thread()
+        if profiling.PROFILER is not None:
+            profiling.PROFILER.run(self._run)
+        else:
+            self._run()
+
+    def _run(self):
+        while self._is_running:
+            timeout = None
+            if self.timers:
+                timeout = max(0., self.timers[0][0] - time.monotonic())
+
+            for key, events in self.selector.select(timeout):
+                if key.data is None:
+                    self._run_pending()
+                    continue
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        key.data.on_writable()
+                    if events & selectors.EVENT_READ:
+                        key.data.on_readable()
+                except Exception as err:
+                    self.log.error(f'{key.data}: {err}')
+
+            # Only the timers due now: those they schedule (even already due) wait for the next select,
+            # so a device can not starve the others.
+            now = time.monotonic()
+            due = []
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+            for callback in due:
+                try:
+                    callback()
+                except Exception as err:
+                    self.log.error(f'{callback}: {err}')
+
+    def start(self):
+        self._is_running = True
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=False)
+        self.thread.start()
+
+    def stop(self):
+        def _stop():
+            self._is_running = False
+        self.call_soon_threadsafe(_stop)
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.devices.clear()
+        self.selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+_shared: Runtime = None
+_shared_users = 0
+_shared_lock = threading.Lock()
+
+
+def acquire_shared_runtime() -> Runtime:
+    """Process wide runtime of the devices started without one. Started on first use."""
+    global _shared, _shared_users
+    with _shared_lock:
+        if _shared is None:
+            _shared = Runtime()
+            _shared.start()
+        _shared_users += 1
+        return _shared
+
+
+def release_shared_runtime():
+    """Stops the shared runtime once its last device is closed, so the process can exit."""
+    global _shared, _shared_users
+    with _shared_lock:
+        _shared_users -= 1
+        if _shared_users == 0 and _shared is not None:
+            _shared.stop()
+            _shared = None
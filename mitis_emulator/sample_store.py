@@ -0,0 +1,127 @@
+"""
+Append-only sample store emulating the SBE37 FLASH memory.
+
+Samples are packed records (time, temperature, conductivity, salinity,
+density) in a numpy array, empty until the first sample and grown by
+doubling up to `capacity`, or in a
+memory-mapped `.npy` file of `capacity` records to persist across restarts
+and keep large stores out of the python heap.
+
+Uploads format the records by blocks, so hundreds of thousands of samples
+are streamed without building the whole upload in memory.
+"""
+
+import time
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import numpy as np
+
+SAMPLE_DTYPE = np.dtype([
+    ("time", "<f8"),  # epoch seconds
+    ("temperature", "<f4"),
+    ("conductivity", "<f4"),
+    ("salinity", "<f4"),
+    ("density", "<f4"),
+])
+
+FLASH_CAPACITY = 530_000  # SBE37-SM: ~530,000 samples of T, C, P.
+UPLOAD_BLOCK = 1000  # samples formatted per upload chunk.
+
+
+class MemoryFull(Exception):
+    pass
+
+
+class SampleStore:
+    __slots__ = ("capacity", "path", "_data", "count")
+
+    def __init__(self, capacity: int = FLASH_CAPACITY, path: str = None):
+        """
+        Parameters
+        ----------
+        path :
+            Memory-mapped `.npy` file. Existing samples are reloaded.
+        """
+        self.capacity = capacity
+        self.path = path
+        self.count = 0
+
+        if path is None:
+            self._data = np.empty(0, dtype=SAMPLE_DTYPE)
+        elif Path(path).is_file():
+            self._data = np.load(path, mmap_mode="r+")
+            self.capacity = len(self._data)
+            self.count = int(np.count_nonzero(self._data["time"]))
+        else:
+            self._data = np.lib.format.open_memmap(path, mode="w+", dtype=SAMPLE_DTYPE, shape=(capacity,))
+
+    def __len__(self):
+        return self.count
+
+    def _reserve(self, n: int):
+        if self.count + n > self.capacity:
+            raise MemoryFull(f'Memory full ({self.capacity} samples).')
+        if self.count + n > len(self._data):
+            data = np.empty(min(self.capacity, max(1024, 2 * len(self._data), self.count + n)), dtype=SAMPLE_DTYPE)
+            data[:self.count] = self._data[:self.count]
+            self._data = data
+
+    def append(self, temperature: float, conductivity: float, salinity: float, density: float, timestamp: float = None):
+        self._reserve(1)
+        self._data[self.count] = (timestamp or time.time(), temperature, conductivity, salinity, density)
+        self.count += 1
+
+    def fill(self, n: int, sample: Tuple[float, float, float, float], interval: float, end: float = None):
+        """Appends `n` copies of `sample`, every `interval` seconds up to `end` (now)."""
+        self._reserve(n)
+        end = time.time() if end is None else end
+        block = self._data[self.count:self.count + n]
+        block["time"] = end - interval * np.arange(n - 1, -1, -1)
+        for name, value in zip(SAMPLE_DTYPE.names[1:], sample):
+            block[name] = value
+        self.count += n
+
+    def clear(self):
+        """InitLogging: the samples are not erased, the pointer is reset."""
+        self.count = 0
+        if self.path is not None:
+            self._data["time"] = 0
+
+    def last(self) -> np.void:
+        return self._data[self.count - 1] if self.count else None
+
+    def samples(self, begin: int = 1, end: int = None) -> np.ndarray:
+        """Samples `begin` to `end` (1-based, inclusive)."""
+        end = self.count if end is None else min(end, self.count)
+        return self._data[max(begin, 1) - 1:end]
+
+    def upload(self, begin: int = 1, end: int = None, block: int = UPLOAD_BLOCK) -> Iterator[bytes]:
+        """Uploaded samples (ascii, `\\r\\n` terminated), by chunks of `block` samples."""
+        end = self.count if end is None else min(end, self.count)
+        for first in range(max(begin, 1), end + 1, block):
+            yield format_samples(self.samples(first, min(first + block - 1, end)))
+
+    def flush(self):
+        if isinstance(self._data, np.memmap):
+            self._data.flush()
+
+
+def format_sample(temperature: float, conductivity: float, salinity: float, density: float) -> str:
+    """
+    Strings Format:
+        temperature:  tttt.tttt (4.4)
+        conductivity:  cc.ccccc (2.5)
+        salinity:     ssss.ssss (4.4)
+        density:       rrr.rrrr (3.4)
+    """
+    return f"{temperature:9.4f},{conductivity:9.5f},{salinity:9.4f},{density:8.4f}"
+
+
+def format_samples(samples: np.ndarray) -> bytes:
+    """Stored samples, with their date and time, as uploaded by DD / GetSamples."""
+    lines = [
+        f"{format_sample(t, c, s, d)}, {time.strftime('%d %b %Y, %H:%M:%S', time.gmtime(ts))}\r\n"
+        for ts, t, c, s, d in samples.tolist()
+    ]
+    return "".join(lines).encode("ascii")
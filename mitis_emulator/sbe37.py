@@ -43,138 +43,226 @@ From Seabird
 
     sl: Send Last Stored Value
 
+    Start / Stop: start (stop) autonomous sampling, every SampleInterval=x
+        seconds. Samples are stored in FLASH and output if TxRealTime=Y.
+    InitLogging: reset the FLASH memory (sample number) to 0.
+    DDb,e / GetSamples:b,e: upload stored samples b to e (1-based). All the
+        samples if omitted.
+        string: 23.7658, 0.00019, 0.062, 20 Oct 2012, 00:51:30
+
 """
 
-import time
-import threading
-import serial
+import itertools
+from typing import List
 
-from .logger import make_logger
+from .device import Device
+from .fanout import FanOut
+from .outbound import OutboundQueue
+from .sample_store import SampleStore, MemoryFull, format_sample
 
-import logging
 
+class SBE37(Device):
+    __slots__ = ("receive_msg", "low_salinity", "store", "sample_interval", "tx_realtime", "transmit_sleep")
 
-class SBE37:
     beaudrate = 19_200
     timeout = .1
     binary_format = 'ascii'
-    buffer_size = 1
-    clock_speed = .1
-    transmit_sleep = 0.01
-
-    def __init__(self, debug=False):
-        log_level = logging.INFO
-        if debug is True:
-            log_level = logging.DEBUG
-
-        self.log = make_logger(self.__class__.__name__, level=log_level)
-
-        self.serial: serial.Serial = None
-        self.thread: threading.Thread = None
-
-        self._is_running = False
+    frame_format = "sbe37"
+    settings = ("low_salinity", "sample_interval", "tx_realtime")
+    interval_setting = "sample_interval"
+
+    # Received message (lower case) -> reply method. Shared by every SBE37.
+    COMMANDS = {
+        "": "prompt",
+        "ts": "sample",
+        "tss": "store_sample",
+        "sl": "send_last",
+        "ds": "status",
+        "start": "start_logging",
+        "startnow": "start_logging",
+        "stop": "stop_logging",
+        "initlogging": "init_logging",
+    }
+    # Commands with parameters: (prefix, reply method).
+    PARAMETER_COMMANDS = (
+        ("sampleinterval=", "set_sample_interval"),
+        ("txrealtime=", "set_tx_realtime"),
+        ("getsamples:", "upload"),
+        ("dd", "upload"),
+    )
+
+    def __init__(self, debug=False, flash: str = None, transmit_sleep: float = 0.01):
+        """
+        Parameters
+        ----------
+        flash :
+            Memory-mapped file of the FLASH memory. In memory by default.
+        transmit_sleep :
+            Delay (seconds) of the replies.
+        """
+        super().__init__(debug=debug)
 
         self.receive_msg = ""
-        self.data_string = ""
+        self.low_salinity = False
+        self.store = SampleStore(path=flash)
+        self.sample_interval = 60.
+        self.tx_realtime = True
+        self.transmit_sleep = transmit_sleep
         self.make_data_string()
 
     @property
-    def is_running(self):
-        return self._is_running
-
-    def open_serial(self, port):
-        self.log.info(f'Opening port: {port}')
-
-        self.serial = serial.Serial()
-        self.serial.baudrate = self.beaudrate
-        self.serial.timeout = self.timeout
-        self.serial.port = port
-
+    def is_logging(self):
+        return self.is_ticking
+
+    def on_bytes(self, data: bytes):
+        buff = data.decode(self.binary_format, errors='replace')
+        self.log.debug(f'Buffer: {buff}')
+
+        *messages, self.receive_msg = (self.receive_msg + buff).split("\r")
+        for msg in messages:
+            self.on_message(msg)
+
+    def on_message(self, msg: str):
+        self.log.info(f'Message received: {msg}')
+
+        command = msg.lower()
+        reply = self.COMMANDS.get(command)
+        if reply is None:
+            reply = next((r for prefix, r in self.PARAMETER_COMMANDS if command.startswith(prefix)), None)
+        if reply is None:
+            self.log.warning(f"Received Unexpected {msg}")
+            return
+
+        # Notes: Unsure if the transmit delay is necessary.
+        self.runtime.call_later(self.transmit_sleep, lambda: getattr(self, reply)(msg))
+
+    def configure(self, **settings):
+        super().configure(**settings)
+        if "low_salinity" in settings:
+            self.make_data_string(low_salinity=settings["low_salinity"])
+
+    def frames(self, n: int) -> List[bytes]:
+        return [(self.data_string + "\r\n").encode(self.binary_format)] * n
+
+    def prompt(self, msg: str):
+        self.send_ready_msg()
+
+    def sample(self, msg: str):
+        self.echo(msg)
+        self.send_data()
+        self.send_ready_msg()
+
+    def store_sample(self, msg: str):
+        """Ignored while logging (only echoed)."""
+        if self.is_logging:
+            self.echo(msg)
+            self.send_ready_msg()
+            return
+        self._store()
+        self.sample(msg)
+
+    def send_last(self, msg: str):
+        """In verification mode, the reply is a data frame: tagged with the next sequence number."""
+        self.echo(msg)
+        last = self.store.last()
+        if last is None:
+            self.send_data()
+        else:
+            self.send(self.tag(format_sample(*last.tolist()[1:])), end_char=True)
+        self.send_ready_msg()
+
+    def status(self, msg: str):
+        self.echo(msg)
+        self.send(f"logging = {'yes' if self.is_logging else 'no'}, sample interval = {self.sample_interval:g} seconds"
+                  f", real-time output = {'yes' if self.tx_realtime else 'no'}", end_char=True)
+        self.send(f"samples = {len(self.store)}, free = {self.store.capacity - len(self.store)}", end_char=True)
+        self.send_ready_msg()
+
+    def _store(self) -> bool:
+        try:
+            self.store.append(*SAMPLES[self.low_salinity])
+            return True
+        except MemoryFull as err:
+            self.log.warning(f'{err}')
+            return False
+
+    def set_sample_interval(self, msg: str):
+        self.echo(msg)
         try:
-            self.serial.open()
-        except serial.serialutil.SerialException as err:
-            self.log.error(f'Ports {err}  does not exist')
-
-    def start(self, port):
-        self.open_serial(port)
-
-        if self.serial.is_open:
-            self._is_running = True
-            self.thread = threading.Thread(target=self.run, daemon=False)
-            self.thread.start()
-
-    def run(self):
-        self.log.info(f"Running ...")
-
-        while self._is_running:
-            time.sleep(self.clock_speed)
-            try:
-                buff = self.serial.read(self.buffer_size).decode(self.binary_format)
-            except Exception as err:
-                self.log.debug(f'Error While reading error: {err}')
-                continue
-
-            if buff == "":
-                continue
-
-            if buff != "\r":
-                self.log.debug(f'Buffer: {buff}')
-                self.receive_msg += buff
-                continue
-
-            self.log.info(f'Message received: {self.receive_msg}')
-
-            _match = self.receive_msg.lower()
-
-            if _match == "":
-                self.transmit_delay()
-                self.send_ready_msg()
-            elif _match in ["ts", "tss", "sl"]:
-                self.transmit_delay()
-                self.echo()
-                self.send_data()
-                self.send_ready_msg()
-            else:
-                self.log.warning(f"Received Unexpected {self.receive_msg}")
-
-            self.receive_msg = ''
-
-    def transmit_delay(self):
+            self.sample_interval = max(float(msg.split("=", 1)[1]), 1.)
+            self.reschedule()
+        except ValueError:
+            self.log.warning(f"Invalid sample interval: {msg}")
+        self.send_ready_msg()
+
+    def set_tx_realtime(self, msg: str):
+        self.echo(msg)
+        self.tx_realtime = msg.split("=", 1)[1].strip().lower() in ("y", "1")
+        self.send_ready_msg()
+
+    def start_logging(self, msg: str):
+        self.echo(msg)
+        if not self.is_logging:
+            self.log.info(f'Logging started. Interval: {self.sample_interval} s')
+            self.start_ticking()
+        self.send_ready_msg()
+
+    def stop_logging(self, msg: str):
+        self.echo(msg)
+        self.stop_ticking()
+        self.log.info(f'Logging stopped. Samples: {len(self.store)}')
+        self.send_ready_msg()
+
+    def on_tick(self):
+        """Autonomous sample, while logging."""
+        if not self._store():
+            self.stop_ticking()
+            return
+        if self.tx_realtime:
+            self.send_data()
+
+    def init_logging(self, msg: str):
+        self.echo(msg)
+        self.store.clear()
+        self.send_ready_msg()
+
+    def upload(self, msg: str):
         """
-        Notes
-        -----
-            Unsure if it necessary
+        DDb,e / GetSamples:b,e. The upload is streamed on the serial port,
+        by blocks of samples, as fast as the port is drained.
         """
-        time.sleep(self.transmit_sleep)
-
-    def send(self, msg: str, end_char=True):
-        if end_char:
-            msg += "\r\n"
-        self.serial.write(msg.encode(self.binary_format))
-        self.log.info(rf'`{msg}` sent')
-
-    def echo(self):
+        arguments = msg[len("getsamples:"):] if msg.lower().startswith("getsamples:") else msg[len("dd"):]
+        try:
+            begin, end = (int(v) for v in arguments.split(",")) if arguments.strip() else (1, None)
+        except ValueError:
+            self.log.warning(f"Invalid upload range: {msg}")
+            self.echo(msg)
+            self.send_ready_msg()
+            return
+
+        self.log.info(f'Uploading samples {begin} to {end or len(self.store)}')
+        self.stream(itertools.chain(
+            [(msg + "\r\n").encode(self.binary_format)],
+            self.store.upload(begin, end),
+            [b"S>"],
+        ))
+
+    def echo(self, msg: str):
         """Send back the received message"""
         self.log.info('Echoing message')
-        self.send(self.receive_msg, end_char=True)
+        self.send(msg, end_char=True)
 
     def send_data(self):
         self.log.info('Sending Sample')
-        self.send(self.data_string, end_char=True)
+        self.send(self.tag(self.data_string), end_char=True)
 
     def send_ready_msg(self):
         self.log.info('Sending Ready Message')
         self.send("S>", end_char=False)
 
     def close(self):
-        self.log.info('Closing Serial')
-        self._is_running = False
-
-        self.log.info('Waiting for thread ...')
-        self.thread.join()
-
-        self.serial.close()
-        self.log.info('Serial Closed')
+        super().close()
+        self.store.flush()
 
     def make_data_string(self, low_salinity=False):
         """
@@ -184,20 +272,43 @@ class SBE37:
             conductivity:  cc.ccccc (2.5)
             salinity:     ssss.ssss (4.4)
             density:       rrr.rrrr (3.4)
-        """
-        temperature = '  23.7658'
-        conductivity = '  0.00019'
-        salinity = '   0.0000' if low_salinity else '  30.1234'
-        density = ' 28.1234'
 
-        self.data_string = ','.join([temperature, conductivity, salinity, density])
+        The strings are shared by every SBE37.
+        """
+        self.low_salinity = low_salinity
+        self.data_string = DATA_STRINGS[low_salinity]
 
         self.log.info(f'Sampled data (len: {len(self.data_string)}): {self.data_string}')
 
 
-def start_SBE37(port: str, debug=False, low_salinity=False):
-    sbe37 = SBE37(debug=debug)
-    sbe37.start(port=port)
+# (temperature, conductivity, salinity, density)
+SAMPLES = {
+    False: (23.7658, 0.00019, 30.1234, 28.1234),
+    True: (23.7658, 0.00019, 0., 28.1234),
+}
+
+DATA_STRINGS = {low_salinity: format_sample(*sample) for low_salinity, sample in SAMPLES.items()}
+
+
+def start_SBE37(port: str, debug=False, low_salinity=False, fanout: FanOut = None,
+                outbound: OutboundQueue = None, flash: str = None, preload: int = 0, verify=False):
+    """
+    Parameters
+    ----------
+    flash :
+        Memory-mapped file of the FLASH memory (kept across restarts).
+    preload :
+        Number of samples (at the sample interval, up to now) stored
+        before starting. E.g. to test the end of deployment upload.
+    verify :
+        Tag the samples with sequence numbers and checksums.
+    """
+    sbe37 = SBE37(debug=debug, flash=flash)
+    if preload:
+        sbe37.store.fill(preload, SAMPLES[low_salinity], interval=sbe37.sample_interval)
+    if verify:
+        sbe37.enable_verification()
+    sbe37.start(port=port, fanout=fanout, outbound=outbound)
 
     return sbe37
 
@@ -206,4 +317,3 @@ if __name__ == '__main__':
     port = '/dev/ttyUSB3'
     s = start_SBE37(port=port)
     s.make_data_string(low_salinity=True)
-
@@ -1,43 +1,219 @@
-from dataclasses import dataclass
+import os
+import threading
+from pathlib import Path
+from typing import Dict
+
 from . import LOCAL_CONFIGURATION_FILE, init_local_file
 from .utils import json2dict
+from .cache import DataCache, derive_seed, CACHE_DIRECTORY, CACHE_MAX_BYTES
+from .config import ConfigWatcher, device_specs, diff_specs, DEVICE_KEYS
+from .device import Device
 from .sbe37 import SBE37
 from .adcp_workhorse import WorkHorse
+from .gps import GPS
+from .logger import make_logger
+from .runtime import Runtime
 
-# replace by and INI file
-
-@dataclass
-class Ports:
-    sbe37: str
-    workhorse: str
+DEVICE_TYPES = {"sbe37": SBE37, "workhorse": WorkHorse, "gps": GPS}
 
 
 init_local_file(silent=True)
 
-CONFIGURATION = json2dict(LOCAL_CONFIGURATION_FILE)
 
-
-PORTS = Ports(**CONFIGURATION['ports'])
+def device_class(device_type: str) -> type:
+    if device_type in DEVICE_TYPES:
+        return DEVICE_TYPES[device_type]
+    from .protocol import load_protocol
+    return load_protocol(device_type).device_class
 
 
 class VirtualDevices:
+    """
+    Devices sharing a single runtime thread, reconciled with the configuration.
+
+    `apply(configuration)` only touches the devices whose configuration
+    changed: removed devices are closed, added devices are started, changed
+    live settings are applied on the runtime thread, and devices whose type,
+    port or constructor parameters changed are restarted. The other devices
+    keep streaming. A device whose new configuration is invalid is reported
+    as `failed` and keeps running its previous configuration.
+    """
     def __init__(self, debug=False):
-        self.sbe37 = SBE37(debug=debug)
-        self.workhorse = WorkHorse(
-            debug=debug,
-            sampling_rate=CONFIGURATION["workhorse_sampling_rate_s"]
-        )
-
-
-def start_devices(debug=False):
+        self.debug = debug
+        self.log = make_logger("VirtualDevices")
+        self.runtime = Runtime()
+        self.devices: Dict[str, Device] = {}
+        self.specs: Dict[str, dict] = {}  # Running configuration of the devices.
+        self.watcher: ConfigWatcher = None
+        self.cache: DataCache = None
+        self._preloaded: Dict[str, int] = {}  # Device name: bytes mapped from the cache.
+
+    def _make_device(self, name: str, spec: dict) -> Device:
+        """Builds the device of `spec`, not started. Raises on an invalid `spec`."""
+        cls = device_class(spec["type"])
+        live = {k: v for k, v in spec.items() if k in cls.settings}
+        kwargs = {k: v for k, v in spec.items() if k not in DEVICE_KEYS and k not in cls.settings}
+
+        device = cls(debug=self.debug, **kwargs)
+        device.configure(**live)
+        if spec.get("preload"):
+            self._preload(name, device, spec)
+        if spec.get("verify"):
+            device.enable_verification()
+        return device
+
+    def _start_device(self, name: str, spec: dict, device: Device):
+        device.start(port=spec["port"], runtime=self.runtime)
+        if not device.is_running:
+            self.log.error(f'{name}: port `{spec["port"]}` could not be opened.')
+            self._preloaded.pop(name, None)
+            return
+        self.devices[name] = device
+        self.specs[name] = spec
+        self.log.info(f'{name}: started on {spec["port"]}')
+
+    def _preload(self, name: str, device: Device, spec: dict):
+        if not hasattr(device, "preload"):
+            self.log.warning(f'{name}: `preload` ignored, {device.__class__.__name__} has no precomputed data.')
+        elif self.cache is None:
+            self.log.warning(f'{name}: `preload` ignored, no `cache` configured.')
+        elif "seed" not in spec:
+            # Cached under a random seed, the data would never be reused and only evict useful entries.
+            self.log.warning(f'{name}: `preload` ignored, no `seed` configured.')
+        else:
+            self._preloaded[name] = device.preload(self.cache, spec["preload"])
+
+    def _check_cache_size(self):
+        preloaded = sum(self._preloaded.values())
+        if self.cache is not None and preloaded > self.cache.max_bytes:
+            self.log.warning(f'Preloaded data ({preloaded / 1024 ** 2:.0f} MiB) does not fit in the cache '
+                             f'(max_mb: {self.cache.max_bytes / 1024 ** 2:.0f}): entries are evicted, and computed '
+                             f'again on restart. Increase `cache.max_mb`.')
+
+    def _configure_cache(self, configuration: dict):
+        cache = configuration.get("cache")
+        if cache is None:
+            self.cache = None
+            return
+        directory = os.path.expanduser(cache.get("directory", CACHE_DIRECTORY))
+        max_bytes = int(cache["max_mb"] * 1024 ** 2) if "max_mb" in cache else CACHE_MAX_BYTES
+        if self.cache is None or self.cache.directory != Path(directory) or self.cache.max_bytes != max_bytes:
+            self.cache = DataCache(directory, max_bytes=max_bytes)
+
+    def _configure_device(self, name: str, settings: dict, timeout: float = 1.):
+        """Applies checked live `settings` on the runtime thread. Raises what `configure` raised."""
+        device = self.devices[name]
+        if threading.current_thread() is self.runtime.thread or not self.runtime.is_running:
+            device.configure(**settings)
+            return
+        done = threading.Event()
+        errors = []
+
+        def configure():
+            try:
+                device.configure(**settings)
+            except Exception as err:
+                errors.append(err)
+            finally:
+                done.set()
+
+        self.runtime.call_soon_threadsafe(configure)
+        if not done.wait(timeout):
+            raise TimeoutError(f'{name}: not configured within {timeout} s.')
+        if errors:
+            raise errors[0]
+
+    def _stop_device(self, name: str):
+        self.specs.pop(name, None)
+        self._preloaded.pop(name, None)
+        device = self.devices.pop(name, None)
+        if device is not None:
+            device.close()
+            self.log.info(f'{name}: stopped')
+
+    def apply(self, configuration: dict) -> Dict[str, list]:
+        """Applies the changes of `configuration` to the running devices. Returns them by kind."""
+        self._configure_cache(configuration)
+        specs = device_specs(configuration)
+        if configuration.get("seed") is not None:
+            for name, spec in specs.items():
+                try:
+                    seeded = device_class(spec["type"]).seeded
+                except Exception:
+                    continue  # Reported when the device is built.
+                if "seed" not in spec and seeded:
+                    spec["seed"] = derive_seed(configuration["seed"], name)
+        removed, added, changed = diff_specs(self.specs, specs)
+        changes = {"removed": removed, "added": [], "restarted": [], "configured": [], "failed": []}
+
+        for name in removed:
+            self._stop_device(name)
+
+        for name in changed:
+            old, new = self.specs[name], specs[name]
+            try:
+                cls = device_class(new["type"])
+                keys = {k for k in set(old) | set(new) if old.get(k) != new.get(k)}
+                restart = old["type"] != new["type"] or not keys <= set(cls.settings) or any(k not in new for k in keys)
+                # Built, or checked, before the running device is touched: kept running if invalid.
+                if restart:
+                    device = self._make_device(name, new)
+                else:
+                    live = cls.check_settings({k: new[k] for k in keys})
+                    self._configure_device(name, live)
+            except Exception as err:
+                changes["failed"].append(name)
+                self.log.error(f'{name}: configuration not applied, still running the previous one: {err}')
+                continue
+            if restart:
+                changes["restarted"].append(name)
+                self._stop_device(name)
+                self._start_device(name, new, device)
+            else:
+                changes["configured"].append(name)
+                self.specs[name] = new
+                self.log.info(f'{name}: {live}')
+
+        for name in added:
+            try:
+                device = self._make_device(name, specs[name])
+            except Exception as err:
+                changes["failed"].append(name)
+                self.log.error(f'{name}: not started: {err}')
+                continue
+            changes["added"].append(name)
+            self._start_device(name, specs[name], device)
+
+        self._check_cache_size()
+        return changes
+
+    def watch(self, path=LOCAL_CONFIGURATION_FILE, interval: float = 1.):
+        self.watcher = ConfigWatcher(path, self.apply, interval=interval)
+        self.watcher.start()
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+        for name in list(self.devices):
+            self._stop_device(name)
+        self.runtime.stop()
+
+
+def start_devices(debug=False, watch=False, watch_interval: float = 1.):
+    """
+    Parameters
+    ----------
+    watch :
+        Applies the changes of the configuration file to the running devices.
+    """
     virtual_devices = VirtualDevices(debug=debug)
-
-    virtual_devices.sbe37.start(port=PORTS.sbe37)
-
-    virtual_devices.workhorse.start(port=PORTS.workhorse)
+    virtual_devices.apply(json2dict(LOCAL_CONFIGURATION_FILE))
+    virtual_devices.runtime.start()
+    if watch:
+        virtual_devices.watch(LOCAL_CONFIGURATION_FILE, interval=watch_interval)
 
     return virtual_devices
 
 
 if __name__ == "__main__":
-    virtual_devices = start_devices()
\ No newline at end of file
+    virtual_devices = start_devices()
@@ -0,0 +1,225 @@
+"""
+End-to-end delivery verification.
+
+In verification mode, the devices tag every data frame with a sequence
+number and a checksum, in fields the format allows:
+
+    pd8   (WorkHorse): ensemble number = sequence % 100000. Checksum
+          (crc32 % 10000) in the timestamp hundredths and the BIT digits.
+          `2023/09/27 12:33:00.cc 00042` ... `BIT: cc`
+    sbe37 (SBE37):     conductivity = sequence % 10**7 (cc.ccccc). Checksum
+          (crc32 % 10000) in the density decimals (rrr.cccc).
+    nmea  (GPS):       speed over ground = sequence % 10**6 / 1000 (knots).
+          Standard NMEA checksum (`*hh`).
+
+The checksums are computed on the frame with the checksum digits zeroed.
+
+`Verifier` stream-checks a capture: frames failing their checksum are
+corrupted; sequence numbers (modulo the field size) are checked for gaps,
+duplicates and reordering (a missing frame arriving late). Lines that are
+not data frames (prompts, echoes, or frames mangled beyond recognition) are
+counted as `other`; the frames lost this way are also counted missing.
+"""
+
+import re
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import BinaryIO, Optional, Tuple
+
+READ_SIZE = 8 * 1024 * 1024
+MISSING_WINDOW = 100_000  # missing sequence numbers remembered to detect reordering.
+
+
+class FrameFormat(ABC):
+    name = ""
+    terminator = b"\r\n"
+    modulus = 1
+
+    @abstractmethod
+    def tag(self, body: str, sequence: int) -> str:
+        """`body` tagged with `sequence` and its checksum."""
+
+    @abstractmethod
+    def check(self, body: bytes) -> Optional[Tuple[int, bool]]:
+        """(sequence, checksum ok) of a data frame. None if `body` is not a data frame."""
+
+
+def _checksum(body: bytes) -> int:
+    return zlib.crc32(body) % 10_000
+
+
+class PD8Format(FrameFormat):
+    name = "pd8"
+    terminator = b"\n\n"
+    modulus = 100_000
+
+    header = re.compile(rb"\d{4}/\d\d/\d\d \d\d:\d\d:\d\d\.(\d\d) (\d{5})\n")
+    bit = re.compile(rb"BIT: (\d\d)\n")
+
+    def tag(self, body: str, sequence: int) -> str:
+        bit = body.index("BIT: ") + 5
+        body = f"{body[:20]}00 {sequence % self.modulus:05d}{body[28:bit]}00{body[bit + 2:]}"
+        checksum = _checksum(body.encode("ascii"))
+        return f"{body[:20]}{checksum // 100:02d}{body[22:bit]}{checksum % 100:02d}{body[bit + 2:]}"
+
+    def check(self, body: bytes) -> Optional[Tuple[int, bool]]:
+        header = self.header.search(body)
+        if header is None:
+            return None
+        body = body[header.start():]  # After a command reply, e.g. `CE`.
+        header = self.header.match(body)
+        bit = self.bit.search(body, header.end())
+        if bit is None:
+            return None
+        checksum = int(header.group(1)) * 100 + int(bit.group(1))
+        zeroed = body[:20] + b"00" + body[22:bit.start(1)] + b"00" + body[bit.end(1):]
+        return int(header.group(2)), _checksum(zeroed) == checksum
+
+
+class SBE37Format(FrameFormat):
+    name = "sbe37"
+    modulus = 10_000_000
+
+    sample = re.compile(rb"[ \d.-]{9},( *\d+)\.(\d{5}),[ \d.-]{9},( *-?\d+)\.(\d{4})$")
+
+    def tag(self, body: str, sequence: int) -> str:
+        temperature, _, salinity, density = body.split(",")
+        sequence %= self.modulus
+        conductivity = f"{sequence // 100_000:3d}.{sequence % 100_000:05d}"
+        density = density.split(".")[0]
+        body = f"{temperature},{conductivity},{salinity},{density}."
+        return f"{body}{_checksum((body + '0000').encode('ascii')):04d}"
+
+    def check(self, body: bytes) -> Optional[Tuple[int, bool]]:
+        match = self.sample.search(body)  # After a prompt, e.g. `S>`.
+        if match is None:
+            return None
+        body = body[match.start():]
+        match = self.sample.match(body)
+        sequence = int(match.group(1)) * 100_000 + int(match.group(2))
+        return sequence, _checksum(body[:match.start(4)] + b"0000") == int(match.group(4))
+
+
+class NMEAFormat(FrameFormat):
+    name = "nmea"
+    modulus = 1_000_000
+
+    SPEED_FIELD = 7
+
+    @staticmethod
+    def nmea_checksum(sentence: bytes) -> int:
+        checksum = 0
+        for byte in sentence:
+            checksum ^= byte
+        return checksum
+
+    def tag(self, body: str, sequence: int) -> str:
+        fields = body.split("*")[0].split(",")
+        fields[self.SPEED_FIELD] = f"{sequence % self.modulus / 1000:.3f}"
+        sentence = ",".join(fields)
+        return f"{sentence}*{self.nmea_checksum(sentence[1:].encode('ascii')):02X}"
+
+    def check(self, body: bytes) -> Optional[Tuple[int, bool]]:
+        body = body[body.find(b"$"):]
+        if not body.startswith(b"$") or body[-3:-2] != b"*":
+            return None
+        fields = body.split(b",")
+        try:
+            sequence = round(float(fields[self.SPEED_FIELD]) * 1000)
+            checksum = int(body[-2:], 16)
+        except (IndexError, ValueError):
+            return None
+        return sequence, self.nmea_checksum(body[1:-3]) == checksum
+
+
+FRAME_FORMATS = {f.name: f for f in (PD8Format(), SBE37Format(), NMEAFormat())}
+
+
+@dataclass
+class VerifyReport:
+    frames: int = 0
+    valid: int = 0
+    corrupted: int = 0
+    missing: int = 0  # frames never received (net of late arrivals).
+    gaps: int = 0  # gap events.
+    duplicates: int = 0
+    reordered: int = 0  # missing frames received late.
+    other: int = 0  # non data lines.
+    bytes: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return not (self.corrupted or self.missing or self.duplicates or self.reordered)
+
+    def as_dict(self) -> dict:
+        return dict(asdict(self), ok=self.ok)
+
+
+class Verifier:
+    def __init__(self, frame_format: str):
+        self.format = FRAME_FORMATS[frame_format]
+        self.report = VerifyReport()
+        self._expected: Optional[int] = None
+        self._missing = OrderedDict()  # sequence: None. Oldest first, at most MISSING_WINDOW.
+        self._rest = b""
+
+    def feed(self, data: bytes):
+        """Checks the complete frames of `data`. Partial frames are kept for the next feed."""
+        self.report.bytes += len(data)
+        *frames, self._rest = (self._rest + data).split(self.format.terminator)
+        for frame in frames:
+            self.check(frame)
+
+    def close(self) -> VerifyReport:
+        if self._rest:
+            self.check(self._rest)
+            self._rest = b""
+        return self.report
+
+    def check(self, frame: bytes):
+        checked = self.format.check(frame)
+        report = self.report
+        if checked is None:
+            report.other += 1
+            return
+        report.frames += 1
+        sequence, valid = checked
+        if not valid:
+            report.corrupted += 1
+            return
+        report.valid += 1
+
+        modulus = self.format.modulus
+        if self._expected is None:
+            self._expected = (sequence + 1) % modulus
+            return
+
+        delta = (sequence - self._expected) % modulus
+        if delta == 0:
+            self._expected = (sequence + 1) % modulus
+        elif delta < modulus // 2:
+            report.gaps += 1
+            report.missing += delta
+            for missing in range(sequence - min(delta, MISSING_WINDOW), sequence):
+                self._missing[missing % modulus] = None
+            while len(self._missing) > MISSING_WINDOW:
+                self._missing.popitem(last=False)
+            self._expected = (sequence + 1) % modulus
+        elif sequence in self._missing:
+            del self._missing[sequence]
+            report.missing -= 1
+            report.reordered += 1
+        else:
+            report.duplicates += 1
+
+
+def verify_stream(stream: BinaryIO, frame_format: str, read_size: int = READ_SIZE) -> VerifyReport:
+    verifier = Verifier(frame_format)
+    while True:
+        data = stream.read(read_size)
+        if not data:
+            break
+        verifier.feed(data)
+    return verifier.close()
@@ -17,7 +17,9 @@ setup(
     long_description=read_file('README.md'),
     long_description_content_type="text/markdown",
     install_requires=[],
+    extras_require={"zstd": ["zstandard"]},
     packages=find_packages(),
+    package_data={"mitis_emulator": ["protocols/*.json"]},
     include_package_data=True,
     classifiers=["Programming Language :: Python :: 3"],
     python_requires="~=3.9",
@@ -0,0 +1,62 @@
+"""Hot reload: an invalid live setting is reported and leaves the running device untouched (ptys)."""
+
+import os
+import time
+import tty
+
+import pytest
+
+from mitis_emulator.server import VirtualDevices
+
+
+@pytest.fixture
+def port():
+    """(master fd, device port)."""
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+    yield master, os.ttyname(slave)
+    os.close(master)
+    os.close(slave)
+
+
+def read_for(master: int, duration: float) -> bytes:
+    data = b""
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        try:
+            data += os.read(master, 1 << 16)
+        except BlockingIOError:
+            time.sleep(.01)
+    return data
+
+
+@pytest.mark.parametrize("invalid", [
+    {"profile": {"speeed": 1}},
+    {"attitude": {"pitch": "level"}},
+    {"sampling_rate": 0},
+    {"sampling_rate": "fast"},
+])
+def test_apply_invalid_live_setting(port, invalid):
+    master, path = port
+    spec = {"type": "workhorse", "port": path, "sampling_rate": 3600}
+    devices = VirtualDevices()
+    devices.runtime.start()
+    try:
+        devices.apply({"devices": {"adcp": spec}})
+        workhorse = devices.devices["adcp"]
+
+        changes = devices.apply({"devices": {"adcp": dict(spec, **invalid)}})
+        assert changes["failed"] == ["adcp"]
+        assert changes["configured"] == []
+        assert devices.specs["adcp"] == spec
+        assert devices.devices["adcp"] is workhorse
+
+        # The runtime still runs the device: a valid change applies.
+        changes = devices.apply({"devices": {"adcp": dict(spec, sampling_rate=.05)}})
+        assert changes["configured"] == ["adcp"]
+        read_for(master, .1)
+        assert read_for(master, .5).count(b"BIT: ") >= 3
+    finally:
+        devices.close()
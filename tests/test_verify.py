@@ -0,0 +1,81 @@
+"""Command replies carrying data frames pass the verifier on a lossless link (ptys)."""
+
+import os
+import time
+import tty
+
+import pytest
+
+from mitis_emulator.adcp_workhorse import WorkHorse
+from mitis_emulator.runtime import Runtime
+from mitis_emulator.sbe37 import SBE37
+from mitis_emulator.verify import Verifier
+
+
+def read_until(master: int, expected: bytes, count: int = 1, timeout: float = 5.) -> bytes:
+    data = b""
+    end = time.monotonic() + timeout
+    while data.count(expected) < count and time.monotonic() < end:
+        try:
+            data += os.read(master, 4096)
+        except BlockingIOError:
+            time.sleep(.01)
+    return data
+
+
+@pytest.fixture
+def link():
+    """(master fd, runtime, device port). The devices are closed by the test."""
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    os.set_blocking(master, False)
+    runtime = Runtime()
+    runtime.start()
+    yield master, runtime, os.ttyname(slave)
+    runtime.stop()
+    os.close(master)
+    os.close(slave)
+
+
+def test_sbe37_send_last(link):
+    master, runtime, port = link
+    device = SBE37(transmit_sleep=0.)
+    device.enable_verification()
+    device.start(port, runtime=runtime)
+    try:
+        os.write(master, b"tss\r")
+        capture = read_until(master, b"S>")
+        os.write(master, b"sl\r")
+        capture += read_until(master, b"S>")
+    finally:
+        device.close()
+
+    verifier = Verifier(device.frame_format)
+    verifier.feed(capture)
+    report = verifier.close()
+    assert report.frames == 2
+    assert report.corrupted == 0
+    assert report.ok
+
+
+def test_workhorse_last_ensemble(link):
+    master, runtime, port = link
+    device = WorkHorse(sampling_rate=.05, seed=0)
+    device.enable_verification()
+    device.start(port, runtime=runtime)
+    try:
+        capture = read_until(master, b"\n\n", count=3)
+        os.write(master, b"===")
+        capture += read_until(master, b">")
+        os.write(master, b"CE\r")
+        capture += read_until(master, b"\r\n>")
+    finally:
+        device.close()
+
+    verifier = Verifier(device.frame_format)
+    verifier.feed(capture)
+    report = verifier.close()
+    assert report.frames >= 4
+    assert report.corrupted == 0
+    assert report.ok